@@ -5,5 +5,54 @@
 #include "throw_darts.h"
 %}
 
-%include throw_darts.h
+%include "stdint.i"
+
+/* Pass writable float64 or int64 buffers such as NumPy arrays as a
+   pointer and a length, using the python buffer protocol */
+
+%define %buffer_typemap(TYPE, FORMATS, MESSAGE)
+
+%typemap(in) (TYPE *vals, int nvals) (Py_buffer view = {NULL}) {
+  if (PyObject_GetBuffer($input, &view, PyBUF_WRITABLE | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) == -1) SWIG_fail;
+  if (view.itemsize != sizeof(TYPE) || strlen(view.format) != 1 || !strchr(FORMATS, view.format[0])) {
+    PyErr_SetString(PyExc_TypeError, MESSAGE);
+    SWIG_fail;
+  }
+  $1 = (TYPE *) view.buf;
+  $2 = view.len / sizeof(TYPE) > INT_MAX ? INT_MAX : (int) (view.len / sizeof(TYPE));
+}
+
+%typemap(freearg) (TYPE *vals, int nvals) {
+  if (view$argnum.obj) PyBuffer_Release(&view$argnum);
+}
+
+%enddef
 
+%buffer_typemap(double, "d", "expected a contiguous float64 array")
+%buffer_typemap(int64_t, "lq", "expected a contiguous int64 array")
+
+%apply (double *vals, int nvals) { (double *pi_vals, int npi), (double *gr_vals, int ngr),
+                                   (double *weights, int nweights) };
+%apply (int64_t *vals, int nvals) { (int64_t *counts, int ncounts) };
+
+/* The functions which take these buffers return -1 if a buffer is
+   too small, which is raised as a ValueError, and otherwise None */
+
+%define %status_typemap(FUNC)
+%typemap(out) int FUNC {
+  if ($1 < 0) {
+    PyErr_SetString(PyExc_ValueError, array_error());
+    SWIG_fail;
+  }
+  $result = SWIG_Py_Void();
+}
+%enddef
+
+%status_typemap(gr_values)
+%status_typemap(run_trials)
+%status_typemap(get_counts)
+%status_typemap(set_counts)
+%status_typemap(get_weights)
+%status_typemap(set_weights)
+
+%include throw_darts.h
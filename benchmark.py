@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# This file is part of a demonstrator for Map/Reduce Monte-Carlo
+# methods.
+
+# This is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# Copyright (c) 2020 Patrick B Warren <patrickbwarren@gmail.com>.
+
+# You should have received a copy of the GNU General Public License
+# along with this file.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the dart throwing engines locally
+
+Eg: ./benchmark.py --nthrow=10^5,10^6 --nbins=20,200 --njobs=1,4 --output=bench.json
+    ./benchmark.py --nthrow=10^5,10^6 --nbins=20,200 --njobs=1,4 --baseline=bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# The engines, as the script to run and a function which returns the
+# script options for a given number of trials, throws and bins
+
+engines = {'pure': ('pure_throw_darts.py', lambda ntrial, nthrow, nbins:
+                    [f'--ntrials={ntrial}', f'--nthrows={nthrow}', f'--nbins={nbins}']),
+           'swig': ('throw_darts.py', lambda ntrial, nthrow, nbins:
+                    [f'--ntrial={ntrial}', f'--nthrow={nthrow}', f'--nbins={nbins}']),
+           'threads': ('throw_darts.py', lambda ntrial, nthrow, nbins:
+                       [f'--ntrial={ntrial}', f'--nthrow={nthrow}', f'--nbins={nbins}',
+                        f'--threads={os.cpu_count()}'])}
+
+parser = argparse.ArgumentParser(__doc__)
+parser.add_argument('--engines', default=','.join(engines), help=f"engines to run, default {','.join(engines)}")
+parser.add_argument('--nthrow', default='10^6', help='number(s) of throws per trial, default 10^6')
+parser.add_argument('--nbins', default='20', help='number(s) of bins in rdf, default 20')
+parser.add_argument('--njobs', default='1', help='number(s) of concurrent jobs, default 1')
+parser.add_argument('--ntrial', default=2, type=int, help='number of trials per job, default 2')
+parser.add_argument('--seed', default=12345, type=int, help='the RNG seed, default 12345')
+parser.add_argument('--repeat', default=3, type=int, help='number of repeats, best is kept, default 3')
+parser.add_argument('--output', default=None, help='save the report to this JSON file')
+parser.add_argument('--baseline', default=None, help='compare against a saved JSON report')
+parser.add_argument('--tolerance', default=0.1, type=float, help='allowed fractional slow down, default 0.1')
+parser.add_argument('--executable', default=sys.executable, help=f'executable to run scripts, if not {sys.executable}')
+parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
+args = parser.parse_args()
+
+def int_list(s):
+    """convert a comma-separated list like 10^5,10^6 to integers"""
+    return [eval(x.replace('^', '**')) for x in s.split(',')] # catch 10^6 etc
+
+def run(engine, ntrial, nthrow, nbins, njobs):
+    """run njobs concurrent jobs, returning the wall time and the peak RSS in kB"""
+    script, opts = engines[engine]
+    tmpdir = tempfile.mkdtemp()
+    header = os.path.join(tmpdir, 'bench')
+    commands = [[args.executable, script, f'--header={header}', f'--seed={args.seed}']
+                + opts(ntrial, nthrow, nbins) + [f'--process={k}', f'--njobs={njobs}']
+                for k in range(njobs)]
+    start = time.perf_counter()
+    pids = [subprocess.Popen(command, stdout=subprocess.DEVNULL).pid for command in commands]
+    peak_rss = 0
+    for pid in pids: # wait4 gives the resource usage of each job
+        _, status, rusage = os.wait4(pid, 0)
+        if status:
+            sys.exit(f'{engine} failed: ' + ' '.join(commands[pids.index(pid)]))
+        peak_rss = max(peak_rss, rusage.ru_maxrss)
+    wall = time.perf_counter() - start
+    shutil.rmtree(tmpdir)
+    return wall, peak_rss
+
+results = []
+
+for engine in args.engines.split(','):
+    for nthrow in int_list(args.nthrow):
+        for nbins in int_list(args.nbins):
+            for njobs in int_list(args.njobs):
+                runs = [run(engine, args.ntrial, nthrow, nbins, njobs) for k in range(args.repeat)]
+                wall = min(wall for wall, _ in runs)
+                peak_rss = max(peak_rss for _, peak_rss in runs)
+                result = {'engine': engine, 'nthrow': nthrow, 'nbins': nbins, 'njobs': njobs,
+                          'ntrial': args.ntrial, 'wall': wall, 'peak_rss_kb': peak_rss,
+                          'throws_per_sec': njobs * args.ntrial * nthrow / wall}
+                results.append(result)
+                if args.verbose:
+                    print(result)
+
+report = {'host': platform.node(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+          'python': platform.python_version(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+          'results': results}
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.verbose:
+        print('Created:', args.output)
+
+# Print a summary, comparing against the baseline if given.  Results
+# are matched on engine, nthrow, nbins, and njobs, and a regression is
+# flagged if the throughput drops by more than the tolerance.
+
+def key(result):
+    return tuple(result[k] for k in ['engine', 'nthrow', 'nbins', 'njobs'])
+
+baseline = {}
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = {key(result): result for result in json.load(f)['results']}
+
+regressions = 0
+
+for result in results:
+    line = '%-8s nthrow=%-10d nbins=%-6d njobs=%-4d %10.4g throws/s %8.3f s %8d kB' % \
+           (*key(result), result['throws_per_sec'], result['wall'], result['peak_rss_kb'])
+    if key(result) in baseline:
+        ratio = result['throws_per_sec'] / baseline[key(result)]['throws_per_sec']
+        line += '  %6.2fx baseline' % ratio
+        if ratio < 1 - args.tolerance:
+            line += '  REGRESSION'
+            regressions += 1
+    print(line)
+
+if regressions:
+    sys.exit(f'{regressions} regression(s) compared to {args.baseline}')
+
+# End of script
@@ -27,8 +27,12 @@ Eg: ./mapper.py throw_darts.py --header=mytest --seed=12345 --ntrial=10 \
 
 import os
 import sys
+import json
+import hashlib
+import itertools
 import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # keep this to include in the job description
 
@@ -49,7 +53,11 @@ parser = argparse.ArgumentParser(__doc__)
 parser.add_argument("script", help="script to be run")
 parser.add_argument('--header', required=True, help='set the name of the output and job files')
 parser.add_argument('--njobs', required=True, type=int, help='the number of condor jobs')
+parser.add_argument('--units', default=None, type=int, help='number of work units for the jobs to share, default njobs')
+parser.add_argument('--group', default=1, type=int, help='number of units run in turn by each job, default 1')
 parser.add_argument('--run', action='store_true', help='run the condor or DAGMan job')
+parser.add_argument('--backend', default='condor', choices=['condor', 'local'], help='where to run the jobs, default condor')
+parser.add_argument('--cores', default=os.cpu_count(), type=int, help=f'number of concurrent local jobs, default {os.cpu_count()}')
 parser.add_argument('--fast', action='store_true', help='run with Mips > min mips')
 parser.add_argument('--min-mips', type=int, default=20000, help='min mips for fast option, default 20000')
 parser.add_argument('--modules', default=None, help='supporting module(s), default None')
@@ -57,14 +65,56 @@ parser.add_argument('--extensions', default='so,py,pm', help='file extensions fo
 parser.add_argument('--executable', default=sys.executable, help=f'executable to run script, if not {sys.executable}')
 parser.add_argument('--transfers', default=None, help='additional files to transfer, default None')
 parser.add_argument('--wipe', default='out,err', help='file extensions for cleaning, default out,err')
+parser.add_argument('--archive', action='store_true', help='jobs write a compressed archive, and stdout is discarded')
+parser.add_argument('--cache', default=None, help='cache directory for job outputs, default None')
+parser.add_argument('--sweep', action='append', default=None, help='sweep a script option over a list of values, as name=v1,v2,...')
+parser.add_argument('--transfer-checkpoints', action='store_true', help='transfer checkpoint files to and from jobs')
 add_bool_arg(parser, 'reduce', default=True, help='use DAGMan to reduce the output')
 add_bool_arg(parser, 'clean', default=True, help='clean up intermediate files')
+add_bool_arg(parser, 'incremental', default=False, help='reduce incrementally, keeping state files')
 add_bool_arg(parser, 'prepend', default=True, help='prepend mapper call to log file')
 parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
 args, rest = parser.parse_known_args()
 
 header, njobs = args.header, args.njobs
 
+# With --units the work is split into a larger number of small units,
+# each of which is run as a separate job with its own process number
+# (and hence RNG stream), with at most njobs running at once.  As each
+# unit finishes, the next is picked up, so faster machines run more of
+# the units.  Without --units, there is one unit per job.
+
+nunits = args.units or njobs
+
+# With --group, each job runs a group of units in turn in the same
+# interpreter (the script is passed --group), so that the start up
+# cost is paid once per group; the units keep their own process
+# numbers and output files, so the reducer is unaffected.
+
+nqueue = -(-nunits // args.group) # the number of jobs to queue
+
+if args.group > 1 and args.transfer_checkpoints:
+    parser.error('--transfer-checkpoints cannot be used with --group')
+
+script_opts = f' --group={args.group}' if args.group > 1 else ''
+
+# With --archive, the script is passed --archive so that each unit
+# writes all its data types to a single compressed archive, and the
+# standard output is discarded, leaving just the archive and the error
+# file for each job.
+
+if args.archive:
+    script_opts += ' --archive'
+
+if args.cache and args.group > 1:
+    parser.error('--cache cannot be used with --group')
+
+# With --cache, only the units whose outputs are not in the cache are
+# run, and the condor jobs are queued over a list of these, so the
+# unit number is $(unit) rather than $(Process).
+
+proc = '$(unit)' if args.cache else '$(Process)'
+
 # Find the files to transfer; include files in the current
 # directory where the file name matches any of the modules in
 # args.modules (comma-separated list) and which have an extension in
@@ -83,73 +133,217 @@ if modules and extensions:
 
 transfers.append(args.script) # add the script itself to the list
 
-# Create the condor job file
+# With --sweep name=v1,v2,... (which can be repeated) the script is
+# run for each point in the grid of option values, with --name=value
+# added to the script options.  The i-th point is a separate set of
+# jobs with the header <header>_<i>, with its own condor job file, and
+# the points are listed in <header>__sweep.json for the reducer.
+# Without --sweep there is just the one point, with the header itself.
+
+if args.sweep:
+    names = [sweep.split('=')[0] for sweep in args.sweep]
+    grid = list(itertools.product(*[sweep.split('=', 1)[1].split(',') for sweep in args.sweep]))
+    points = [(f'{header}_{i}', [f'--{name}={value}' for name, value in zip(names, values)])
+              for i, values in enumerate(grid)]
+    with open(f'{header}__sweep.json', 'w') as f:
+        json.dump({'command': command_line, 'names': names,
+                   'points': [[point, values] for (point, _), values in zip(points, grid)]}, f)
+    if args.verbose:
+        print(f'Sweeping {len(points)} points:', ' '.join(args.sweep))
+else:
+    points = [(header, [])]
+
+# With --cache, the outputs of each unit are kept in the cache
+# directory under a key which is a hash of the contents of the files
+# transferred (so including the script and modules), the script
+# options other than --header, the number of units, and the unit
+# number.  The keys are saved to <header>__keys.json (for each point)
+# for the reducer, which stores the outputs of the units which are run
+# in the cache, and restores the others from it.
+
+jobs = {point: range(nqueue) for point, _ in points} # the process numbers of the jobs to run
+
+if args.cache:
+    digest = hashlib.sha256()
+    for transfer in sorted(transfers):
+        with open(transfer, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    for point, point_opts in points:
+        params = [digest.hexdigest(), args.script, rest + point_opts, script_opts, nunits]
+        keys = [hashlib.sha256(json.dumps(params + [k]).encode()).hexdigest() for k in range(nunits)]
+        with open(f'{point}__keys.json', 'w') as f:
+            json.dump(keys, f)
+        jobs[point] = [k for k in range(nunits) if not os.path.isdir(os.path.join(args.cache, keys[k]))]
+    nqueue = sum(len(jobs[point]) for point, _ in points)
+    if args.verbose:
+        print(f'{len(points)*nunits - nqueue} of {len(points)*nunits} units found in {args.cache}')
+
+# For checkpointing, each job has a checkpoint file <header>__<proc_id>.ckpt
+# which is transferred back if the job is evicted, and transferred
+# in when the job restarts.  Empty placeholder files are created here
+# so that the files exist for the first transfer, and these are
+# cleaned up along with the output and error files.
+
+wipe = args.wipe
 
-condor_job = header + '__condor.job'
+if args.transfer_checkpoints:
+    for point, _ in points:
+        for k in jobs[point]:
+            open(f'{point}__{k}.ckpt', 'a').close()
+    wipe = ','.join(filter(None, [wipe, 'ckpt']))
+
+# Create the condor job files, one for each point
 
 # Add a requirements line if requested (newlines are required to
 # insert as lines in constructing the script below).
 
 extra = f'\nrequirements = Mips > {args.min_mips}' if args.fast else ''
 
+# Limit the number of units in the queue at once, using late materialization
+
+if args.units:
+    extra += f'\nmax_materialize = {njobs}'
+
 # Reconstruct the verbosity and stick on the end of the unmatched arguments
 
 if args.verbose:
     rest.append('-' + 'v' * args.verbose)
     
-opts = ' '.join(rest) # now contains all the unmatched arguments
-
-# The actual job description using an f-string
-
-lines = [f'# {command_line}',
-         'should_transfer_files = YES',
-         'when_to_transfer_output = ON_EXIT',
-         'notification = never',
-         'universe = vanilla',
-         f'opts = {opts}{extra}',
-         'transfer_input_files = ' + ','.join(transfers),
-         f'executable = {args.executable}',
-         f'arguments = {args.script} --header={header} $(opts) --process=$(Process) --njobs={njobs}',
-         f'output = {header}__$(Process).out',
-         f'error = {header}__$(Process).err',
-         f'queue {njobs}']
-
-with open(condor_job, 'w') as f:
-    f.write('\n'.join(lines) + '\n')
+# The actual job descriptions using f-strings
 
-if args.verbose:
-    print('Created:', condor_job)
+condor_jobs = {}
+
+for point, point_opts in points:
+
+    opts = ' '.join(rest + point_opts) # now contains all the unmatched arguments
+
+    output = os.devnull if args.archive else f'{point}__{proc}.out'
+
+    checkpoints = [f'{point}__{proc}.ckpt'] if args.transfer_checkpoints else []
+
+    lines = [f'# {command_line}',
+             'should_transfer_files = YES',
+             'when_to_transfer_output = ' + ('ON_EXIT_OR_EVICT' if args.transfer_checkpoints else 'ON_EXIT'),
+             'notification = never',
+             'universe = vanilla',
+             f'opts = {opts}{extra}',
+             'transfer_input_files = ' + ','.join(transfers + checkpoints),
+             f'executable = {args.executable}',
+             f'arguments = {args.script} --header={point} $(opts) --process={proc}{script_opts} --njobs={nunits}',
+             f'output = {output}',
+             f'error = {point}__{proc}.err',
+             f'queue unit in ({", ".join(map(str, jobs[point]))})' if args.cache else f'queue {nqueue}']
 
-if not args.reduce: # we just need to run the condor job
+    condor_jobs[point] = point + '__condor.job'
 
-    run_command = 'condor_submit ' + condor_job
+    with open(condor_jobs[point], 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    if args.verbose:
+        print('Created:', condor_jobs[point])
 
-else: # create a DAGMan master job
+# The reducer command, run as a DAGMan POST script or directly after
+# the local jobs have completed
 
-    dag_job = header + '__dag.job'
+if args.reduce:
 
     opts = ['--clean' if args.clean else '--no-clean', 
             '--prepend' if args.prepend else '--no-prepend',
-            f'--wipe={args.wipe}', f'--njobs={njobs}']
+            '--incremental' if args.incremental else '--no-incremental',
+            f'--wipe={wipe}', f'--njobs={nunits}']
+
+    if args.cache:
+        opts.append(f'--cache={args.cache}')
+
+    if args.sweep:
+        opts.append('--sweep')
     
     script = f"{args.executable} reducer.py {header} {' '.join(opts)}"
 
-    lines = [f'JOB A {condor_job}',
-             f'SCRIPT POST A {script}']
+if args.backend == 'local': # run the jobs in a local process pool
 
-    with open(dag_job, 'w') as f:
-        f.write('\n'.join(lines) + '\n')
+    # Each job gets the same arguments as in the condor job
+    # description, and the same output and error files.  The condor
+    # job file is kept as a record of the mapper command line, which
+    # the reducer prepends to the log file.  With --sweep the jobs for
+    # all the points share the pool, with njobs per point at once.
 
-    if args.verbose:
-        print('Created:', dag_job)
+    point_opts = dict(points)
 
-    run_command = 'condor_submit_dag -notification Never ' + dag_job
+    tasks = [(point, k) for point, _ in points for k in jobs[point]]
 
-# We run if required, otherwise print out the run command for the user
+    cores = min(args.cores, njobs * len(points))
 
-if args.run: 
-    subprocess.call(run_command, shell=True)
-else:
-    print(run_command)
+    def job_command(point, k):
+        return [args.executable, args.script, f'--header={point}'] + rest + point_opts[point] \
+            + [f'--process={k}'] + script_opts.split() + [f'--njobs={nunits}']
+
+    def run_job(task):
+        """run the k-th job for a point as a subprocess, returning the exit code"""
+        point, k = task
+        output = os.devnull if args.archive else f'{point}__{k}.out'
+        with open(output, 'w') as out, open(f'{point}__{k}.err', 'w') as err:
+            return subprocess.call(job_command(point, k), stdout=out, stderr=err)
+
+    if args.run:
+        with ThreadPoolExecutor(max_workers=cores) as pool:
+            codes = list(pool.map(run_job, tasks))
+        failed = [k if point == header else f'{point}__{k}' for (point, k), code in zip(tasks, codes) if code]
+        if failed:
+            print('failed jobs:', ','.join(str(k) for k in failed))
+        elif args.reduce:
+            subprocess.call(script, shell=True)
+        if args.verbose:
+            print(f'Ran {len(tasks)} jobs on {cores} cores')
+    else:
+        for point, k in tasks:
+            print(' '.join(job_command(point, k)), f'> {point}__{k}.out 2> {point}__{k}.err')
+        if args.reduce:
+            print(script)
+
+else: # submit to condor
+
+    # Only the points with jobs to run are submitted (with --cache some
+    # may have none).  With --sweep the DAG has a node for each point,
+    # and a NOOP node which is a child of all these, whose POST script
+    # reduces all the points at once.
+
+    nodes = {f'P{i}': condor_jobs[point] for i, (point, _) in enumerate(points) if jobs[point]}
+
+    if not args.reduce: # we just need to run the condor job(s)
+
+        run_command = 'condor_submit ' + ' '.join(nodes.values())
+
+    elif not nodes: # everything is in the cache, so just reduce
+
+        run_command = script
+
+    else: # create a DAGMan master job
+
+        dag_job = header + '__dag.job'
+
+        if args.sweep:
+            lines = [f'JOB {node} {condor_job}' for node, condor_job in nodes.items()]
+            lines.extend([f'JOB R {condor_jobs[points[0][0]]} NOOP',
+                          'PARENT ' + ' '.join(nodes) + ' CHILD R',
+                          f'SCRIPT POST R {script}'])
+        else:
+            lines = [f'JOB A {condor_jobs[header]}',
+                     f'SCRIPT POST A {script}']
+
+        with open(dag_job, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        if args.verbose:
+            print('Created:', dag_job)
+
+        run_command = 'condor_submit_dag -notification Never ' + dag_job
+
+    # We run if required, otherwise print out the run command for the user
+
+    if args.run: 
+        subprocess.call(run_command, shell=True)
+    else:
+        print(run_command)
 
 # End of script
@@ -99,4 +99,59 @@ static inline double pcg64_random_d(pcg64_random_t* rng) {
   return (x >> 11) * (1.0 / A_JOLLY_BIG_NUMBER);
 }
 
+/* Advance the RNG by delta steps in O(log delta) operations, based on
+   the jump-ahead algorithm of F. Brown, "Random Number Generation with
+   Arbitrary Stride", Trans. Am. Nucl. Soc. (Nov. 1994). */
+
+static inline pcg128_t pcg_advance_lcg_128(pcg128_t state, pcg128_t delta,
+					   pcg128_t cur_mult, pcg128_t cur_plus) {
+  pcg128_t acc_mult = 1U, acc_plus = 0U;
+  while (delta > 0) {
+    if (delta & 1) {
+      acc_mult *= cur_mult;
+      acc_plus = acc_plus * cur_mult + cur_plus;
+    }
+    cur_plus = (cur_mult + 1) * cur_plus;
+    cur_mult *= cur_mult;
+    delta /= 2;
+  }
+  return acc_mult * state + acc_plus;
+}
+
+static inline void pcg64_advance_r(pcg64_random_t* rng, pcg128_t delta) {
+  rng->state = pcg_advance_lcg_128(rng->state, delta,
+				   PCG_DEFAULT_MULTIPLIER_128, rng->inc);
+}
+
+/* Fill an array with n random doubles, identical to n successive
+   calls to pcg64_random_d.  The LCG is run as PCG64_LANES interleaved
+   sequences, each jumping PCG64_LANES steps at a time, so that the
+   multiplications are independent and can proceed in parallel. */
+
+#define PCG64_LANES 4
+
+static inline void pcg64_random_fill_d(pcg64_random_t* rng, double *u, int n) {
+  pcg128_t s[PCG64_LANES], mult = 1U, plus = 0U, last = rng->state;
+  int j, l;
+  for (l=0; l<PCG64_LANES; l++) {
+    last = last * PCG_DEFAULT_MULTIPLIER_128 + rng->inc;
+    s[l] = last;
+    mult *= PCG_DEFAULT_MULTIPLIER_128;
+    plus = plus * PCG_DEFAULT_MULTIPLIER_128 + rng->inc;
+  }
+  last = rng->state;
+  for (j=0; j+PCG64_LANES<=n; j+=PCG64_LANES) {
+    last = s[PCG64_LANES-1];
+    for (l=0; l<PCG64_LANES; l++) {
+      u[j+l] = (pcg_output_xsl_rr_128_64(s[l]) >> 11) * (1.0 / A_JOLLY_BIG_NUMBER);
+      s[l] = s[l] * mult + plus;
+    }
+  }
+  for (l=0; j+l<n; l++) {
+    u[j+l] = (pcg_output_xsl_rr_128_64(s[l]) >> 11) * (1.0 / A_JOLLY_BIG_NUMBER);
+    last = s[l];
+  }
+  rng->state = last;
+}
+
 #endif /* PCG64_H_INCLUDED */
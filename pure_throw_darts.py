@@ -27,61 +27,220 @@
 Eg: ./throw_darts.py --header=mytest --seed=12345 --ntrial=100 --nthrow=10^6 -v
 """
 
+import os
+import json
+import time
+import struct
+import zipfile
 import argparse
+import resource
+
+# For --metrics, as in throw_darts.py
+
+startup_time = sum(os.times()[:2])
+start_time = time.perf_counter()
+
 import numpy as np
 
+import_time = time.perf_counter() - start_time
+
 # Parse the argument list
 
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--header', required=True, help='set the name of the output files')
 parser.add_argument('--seed', default=12345, type=int, help='the RNG seed, default 12345')
 parser.add_argument('--process', default=0, type=int, help='process number, default 0')
+parser.add_argument('--group', default=1, type=int, help='number of processes to run in turn, default 1')
 parser.add_argument('--njobs', default=1, type=int, help='the number of condor jobs, deault 1')
 parser.add_argument('--ntrials', default=10, type=int, help='number of trials, default 10')
 parser.add_argument('--nthrows', default='1000', help='number of throws per trial, default 1000')
 parser.add_argument('--nbins', default='20', type=int, help='number of bins in rdf, default 20')
+parser.add_argument('--sampling', default='uniform', choices=['uniform', 'stratified', 'polar'], help='sampling strategy, default uniform')
+parser.add_argument('--strata', default=10, type=int, help='number of strata along each side for stratified sampling, default 10')
+parser.add_argument('--partition', default='stream', choices=['stream', 'skip'], help='RNG partitioning between processes, default stream')
+parser.add_argument('--trial-offset', default=0, type=int, help='index of the first trial with --partition=skip, default 0')
+parser.add_argument('--chunk', default='10^5', help='number of throws per vectorised chunk, default 10^5')
+parser.add_argument('--binary', action='store_true', help='write data files in binary format')
+parser.add_argument('--archive', action='store_true', help='write the data files into a single compressed archive')
+parser.add_argument('--metrics', action='store_true', help='write a metrics file with timings for the job')
 parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
 args = parser.parse_args()
 
 ntrials, nbins = args.ntrials, args.nbins
 nthrows = eval(args.nthrows.replace('^', '**')) # catch 10^6 etc
+chunk = eval(args.chunk.replace('^', '**'))
+
+njobs = args.njobs
+rngs = np.random.default_rng(seed=args.seed).spawn(njobs) # the local RNG streams
+
+# With --group, as in throw_darts.py, the processes process*group, ...
+# are run in turn, each with its own RNG stream and output files
+
+processes = [p for p in range(args.process*args.group, (args.process+1)*args.group) if p < njobs]
 
-pid, njobs = args.process, args.njobs
-local_rng = np.random.default_rng(seed=args.seed).spawn(njobs)[pid] # select a local RNG stream
+def write_binary(data_file, tags, rows, mode='wb'):
+    """write rows of values in binary format, with a header if mode is 'wb'"""
+    width = 32 # must be big enough for the tags
+    with open(data_file, mode) as f:
+        if mode == 'wb':
+            f.write(b'MRMC' + struct.pack('<III', 1, len(tags), width))
+            f.write(b''.join(tag.encode().ljust(width, b'\0') for tag in tags))
+        np.asarray(rows, dtype='<f8').tofile(f)
 
 gr_bins = np.zeros(1+nbins, dtype=int)
+wgr_bins = np.zeros(1+nbins) # sums of r for polar sampling
+
+# The sampling strategies are as in throw_darts.c: stratified sampling
+# cycles through an m x m grid of sub-squares, and polar sampling draws
+# r uniformly in [0,1), giving each throw the weight pi r / 2
+
+m = args.strata
+
+ig = np.arange(nbins)
+r = (ig + 0.5) / nbins
+area_annulus = np.pi * ((ig+1)**2 - ig**2) / nbins**2
+
+# With --partition=skip the trials are drawn from a global sequence of
+# trials, exactly as in throw_darts.c: the RNG is a PCG64 generator
+# seeded as by pcg64_srandom_r with stream 0, and advanced to the start
+# of each trial.  The bins and the annulus areas are then computed with
+# the same arithmetic as throw_darts.c, so the results are the same
+# (with --binary, since the text output for pi differs in precision),
+# apart from rounding in the weight sums for polar sampling unless
+# throw_darts.c uses one thread and nthrows <= chunk.
+
+skip = args.partition == 'skip'
+delg = 1.0 / nbins
+
+if skip:
+    area_annulus = np.pi * ((ig+1)**2 - ig**2) * delg * delg
+
+draws_per_throw = 1 if args.sampling == 'polar' else 2
 
-pi_estimate = np.zeros(ntrials)
+def skip_rng(trial):
+    """return a generator at the start of the given trial in the global sequence"""
+    mult = (2549297995355413924 << 64) + 4865540595714422341 # PCG_DEFAULT_MULTIPLIER_128
+    state = ((1 + args.seed % 2**64) * mult + 1) % 2**128 # as pcg64_srandom_r(seed, 0)
+    bit_generator = np.random.PCG64(0)
+    bit_generator.state = {'bit_generator': 'PCG64', 'state': {'state': state, 'inc': 1},
+                           'has_uint32': 0, 'uinteger': 0}
+    bit_generator.advance(draws_per_throw * nthrows * trial)
+    return np.random.Generator(bit_generator)
 
-pi_file = '%s__%d_pi.dat' % (args.header, pid)
-gr_file = '%s__%d_gr.dat' % (args.header, pid)
 log_file = '%s.log' % args.header
 
-for trial in range(ntrials):
-    gr_bins[:] = 0
-    for throw in range(nthrows):
-        x, y = local_rng.uniform(-1.0, 1.0, 2)
-        ig = min(nbins, int(np.sqrt(x**2+y**2)*nbins))
-        gr_bins[ig] = gr_bins[ig] + 1
-    pi_estimate[trial] = 4.0 * np.sum(gr_bins[:-1]) / nthrows
-    mode = 'w' if trial == 0 else 'a'
-    with open(gr_file, mode) as f:
-        for ig in range(nbins):
-            r = (ig + 0.5) / nbins
-            area_annulus = np.pi * ((ig+1)**2 - ig**2) / nbins**2
-            g = 4.0 * gr_bins[ig] / (nthrows * area_annulus)
-            f.write('%g\tgr__%g\n' % (g, r))
-
-with open(pi_file, 'w') as f:
-    for x in pi_estimate:
-        f.write('%g\tpi\n' % x)
+job_start = start_time
+
+for pid in processes:
+
+    local_rng = rngs[pid] # select a local RNG stream
+
+    pi_estimate = np.zeros(ntrials)
+
+    pi_file = '%s__%d_pi.dat' % (args.header, pid)
+    gr_file = '%s__%d_gr.dat' % (args.header, pid)
+
+    # The data files are written to temporary files, which are renamed
+    # (or packed into the archive) once complete, as in throw_darts.py
+
+    pi_tmp, gr_tmp = pi_file + '.tmp', gr_file + '.tmp'
+    open(gr_tmp, 'w').close() # in case there are no trials
+
+    # With polar sampling there is no estimate of pi (every throw lands
+    # in the target, and the weights already contain pi), as in
+    # throw_darts.py, so only the g(r) data is written.
+
+    polar = args.sampling == 'polar'
+
+    throw_time = write_time = 0.0
+    trial_start = time.perf_counter()
+
+    for trial in range(ntrials):
+        throw_start = time.perf_counter()
+        if skip:
+            local_rng = skip_rng(args.trial_offset + pid * ntrials + trial)
+        gr_bins[:] = 0
+        wgr_bins[:] = 0.0
+        for start in range(0, nthrows, chunk): # the (x, y) pairs are drawn in the same order as one at a time
+            if args.sampling == 'polar':
+                u = local_rng.random(min(chunk, nthrows-start))
+                ig = np.minimum(nbins-1, (u*nbins).astype(int))
+                wgr_bins += np.bincount(ig, weights=u, minlength=1+nbins)
+            else:
+                if args.sampling == 'stratified':
+                    s = np.arange(start, min(start+chunk, nthrows)) % (m*m)
+                    u, v = local_rng.random((len(s), 2)).T
+                    x, y = 2.0/m * (s % m + u) - 1.0, 2.0/m * (s // m + v) - 1.0
+                else:
+                    x, y = local_rng.uniform(-1.0, 1.0, (min(chunk, nthrows-start), 2)).T
+                rr = np.sqrt(x**2+y**2)
+                ig = np.minimum(nbins, (rr / delg if skip else rr * nbins).astype(int))
+            gr_bins += np.bincount(ig, minlength=1+nbins)
+        throw_time += time.perf_counter() - throw_start
+        counts = np.pi/2 * wgr_bins[:-1] if polar else gr_bins[:-1]
+        if not polar:
+            pi_estimate[trial] = 4.0 * np.sum(counts) / nthrows
+        g = 4.0 * counts / (nthrows * area_annulus)
+        write_start = time.perf_counter()
+        mode = 'w' if trial == 0 else 'a'
+        if args.binary:
+            write_binary(gr_tmp, ['gr__%g' % x for x in r], g, mode+'b')
+        else:
+            with open(gr_tmp, mode) as f:
+                for ig in range(nbins):
+                    f.write('%g\tgr__%g\n' % (g[ig], r[ig]))
+        write_time += time.perf_counter() - write_start
+
+    trial_time = time.perf_counter() - trial_start - write_time
+    write_start = time.perf_counter()
+
+    data_files = {'gr': (gr_tmp, gr_file)} # by data type, the temporary and final files
+
+    if not polar:
+        data_files['pi'] = (pi_tmp, pi_file)
+        if args.binary:
+            write_binary(pi_tmp, ['pi'], pi_estimate)
+        else:
+            with open(pi_tmp, 'w') as f:
+                for x in pi_estimate:
+                    f.write('%g\tpi\n' % x)
+
+    if args.archive: # move the data files into an archive, as in throw_darts.py
+        archive = '%s__%d.zip' % (args.header, pid)
+        with zipfile.ZipFile(archive + '.tmp', 'w', zipfile.ZIP_DEFLATED) as z:
+            for data_type, (tmp_file, _) in data_files.items():
+                z.write(tmp_file, f'{data_type}.dat')
+        os.replace(archive + '.tmp', archive)
+        for tmp_file, _ in data_files.values():
+            os.remove(tmp_file)
+    else:
+        for tmp_file, data_file in data_files.values():
+            os.replace(tmp_file, data_file)
+
+    write_time += time.perf_counter() - write_start
+
+    if args.metrics: # as in throw_darts.py
+        wall = time.perf_counter() - job_start
+        metrics = {'script': os.path.basename(__file__), 'process': pid, 'threads': 1,
+                   'ntrial': ntrials, 'nthrow': nthrows, 'startup_cpu': startup_time,
+                   'import': import_time, 'throw': throw_time, 'trials': trial_time,
+                   'write': write_time, 'wall': wall,
+                   'throws_per_sec': ntrials * nthrows / wall,
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        with open('%s__%d.metrics' % (args.header, pid), 'w') as f:
+            json.dump(metrics, f)
+            f.write('\n')
+
+    startup_time = import_time = 0.0
+    job_start = time.perf_counter()
 
 run_opts = [f'--header={args.header}', f'--seed={args.seed}',
             f'--ntrials={ntrials}', f'--nthrows={nthrows}',
-            f'--nbins={nbins}']
+            f'--nbins={nbins}', f'--sampling={args.sampling}',
+            f'--partition={args.partition}', f'--trial-offset={args.trial_offset}']
 
-if args.process == 0:
+if 0 in processes:
     with open(log_file, 'w') as f:
         f.write(f'# {__file__}\n')
         f.write('# opts: ' + ' '.join(run_opts) + '\n')
-        f.write('# data collected for: pi, gr\n')
+        f.write('# data collected for: ' + ('gr' if args.sampling == 'polar' else 'pi, gr') + '\n')
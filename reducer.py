@@ -24,8 +24,17 @@
 Eg: ./reducer.py --header=mytest --njobs=8
 """
 
+import io
 import os
+import sys
+import json
+import shutil
+import struct
+import zipfile
 import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # The following code snippet comes from
 # https://stackoverflow.com/questions/15008758/parsing-boolean-values-with-argparse
@@ -46,11 +55,107 @@ parser.add_argument('--njobs', default=None, type=int, help='the number of condo
 parser.add_argument('--wipe', default='out,err', help='file extensions for cleaning, default out,err')
 parser.add_argument('--data-types', default=None, help='over-ride list of data types')
 add_bool_arg(parser, 'overwrite', default=False, help='overwrite data files')
+add_bool_arg(parser, 'stream', default=False, help='reduce in a single pass with running statistics')
+add_bool_arg(parser, 'incremental', default=False, help='only reduce new job outputs, keeping state files')
+parser.add_argument('--cache', default=None, help='cache directory for job outputs, default None')
+parser.add_argument('--sweep', action='store_true', help='reduce all the points of a parameter sweep')
+parser.add_argument('--workers', default=1, type=int, help='number of parallel reduction processes, default 1')
 add_bool_arg(parser, 'clean', default=False, help='clean up intermediate files')
 add_bool_arg(parser, 'prepend', default=True, help='prepend mapper call to log file')
 parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
 args = parser.parse_args()
 
+if args.incremental and not args.njobs:
+    parser.error('--incremental requires --njobs')
+
+if args.cache and not args.njobs:
+    parser.error('--cache requires --njobs')
+
+if args.sweep and not args.njobs:
+    parser.error('--sweep requires --njobs')
+
+# With --sweep (as passed by mapper.py), the points of the sweep are
+# taken from <header>__sweep.json, and each point is reduced by running
+# this script for the point's header with the same options, --workers
+# points at a time.  The results are then combined into a single table
+# <header>_<data_type>.dat, in which the values of the swept options
+# for each point are appended as extra columns, in the order listed in
+# <header>.log.
+
+if args.sweep:
+    with open(f'{args.header}__sweep.json') as f:
+        sweep = json.load(f)
+    opts = ['--overwrite' if args.overwrite else '--no-overwrite',
+            '--stream' if args.stream else '--no-stream',
+            '--incremental' if args.incremental else '--no-incremental',
+            '--clean' if args.clean else '--no-clean',
+            '--prepend' if args.prepend else '--no-prepend',
+            f'--wipe={args.wipe}', f'--njobs={args.njobs}']
+    if args.data_types:
+        opts.append(f'--data-types={args.data_types}')
+    if args.cache:
+        opts.append(f'--cache={args.cache}')
+    if args.verbose:
+        opts.append('-' + 'v' * args.verbose)
+    def reduce_point(point):
+        """reduce the outputs for a point of the sweep, returning the exit code"""
+        return subprocess.call([sys.executable, __file__, point] + opts)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        codes = list(pool.map(reduce_point, [point for point, values in sweep['points']]))
+    if args.data_types:
+        data_types = args.data_types.split(',')
+    else:
+        with open(sweep['points'][0][0] + '.log') as f:
+            for line in f:
+                if 'data collected for' in line:
+                    data_types = [s.strip() for s in line.split(':')[1].split(',')]
+    for data_type in data_types:
+        data_file = f'{args.header}_{data_type}.dat'
+        if not args.overwrite and not args.incremental and os.path.exists(data_file):
+            print(f'{data_file} exists, use --overwrite option to overwrite')
+            continue
+        with open(data_file, 'w') as f:
+            for (point, values), code in zip(sweep['points'], codes):
+                if code:
+                    print(f'failed to reduce {point}, skipping')
+                    continue
+                with open(f'{point}_{data_type}.dat') as g:
+                    for line in g:
+                        f.write(line.rstrip('\n') + '\t' + '\t'.join(values) + '\n')
+        if args.verbose:
+            print(f'{data_type} > {data_file}')
+    with open(args.header + '.log', 'w') as f:
+        if args.prepend:
+            f.write(f"# {sweep['command']}\n")
+        f.write('# sweep over: ' + ','.join(sweep['names']) + '\n')
+        f.write('# data collected for: ' + ','.join(data_types) + '\n')
+    sys.exit(1 if any(codes) else 0)
+
+# The directory is listed once, rather than checking for each file in
+# turn, and the listing is kept up to date with any files restored
+# from the cache.
+
+directory = os.path.dirname(args.header)
+existing = {os.path.join(directory, entry.name) for entry in os.scandir(directory or '.')}
+
+# With --cache (as passed by mapper.py), the outputs of each job are
+# kept in a sub-directory of the cache directory named by the job's
+# key, taken from <header>__keys.json as written by mapper.py.  The
+# outputs of jobs which have been run are stored in the cache, and the
+# outputs of the others (not run since they were found in the cache)
+# are restored from it.  The log file is kept with the outputs of job
+# 0, and restored first since it gives the list of data types.
+
+log_file = args.header + '.log'
+
+if args.cache:
+    with open(f'{args.header}__keys.json') as f:
+        keys = json.load(f)
+    cached_log = os.path.join(args.cache, keys[0], 'run.log')
+    if os.path.exists(cached_log):
+        shutil.copyfile(cached_log, log_file)
+        existing.add(log_file)
+
 # Extract the list of data types from the log file (or override).
 # In the log file, look for a line like
 # ... data collected for ... : type1,type2,type3,...
@@ -60,45 +165,311 @@ args = parser.parse_args()
 if args.data_types:
     data_types = args.data_types.split(',')
 else:
-    with open(args.header + '.log') as f:
+    with open(log_file) as f:
         for line in f:
             if 'data collected for' in line:
                 data_types = [s.strip() for s in line.split(':')[1].split(',')]
 
+def job_files(k):
+    """return the output files of job k, keyed by their names in the cache"""
+    archive = f'{args.header}__{k}.zip'
+    if archive in existing:
+        return {'job.zip': archive}
+    return {f'{data_type}.dat': f'{args.header}__{k}_{data_type}.dat' for data_type in data_types}
+
+if args.cache:
+    restored, stored = 0, 0
+    for k in range(args.njobs):
+        entry, files = os.path.join(args.cache, keys[k]), job_files(k)
+        if os.path.isdir(entry): # restore
+            for name in os.listdir(entry):
+                if name != 'run.log':
+                    job_file = f'{args.header}__{k}.zip' if name == 'job.zip' else f'{args.header}__{k}_{name}'
+                    shutil.copyfile(os.path.join(entry, name), job_file)
+                    existing.add(job_file)
+            restored += 1
+        elif all(job_file in existing for job_file in files.values()): # store
+            os.makedirs(entry + '.tmp', exist_ok=True)
+            if k == 0 and log_file in existing:
+                files['run.log'] = log_file
+            for name, job_file in files.items():
+                shutil.copyfile(job_file, os.path.join(entry + '.tmp', name))
+            os.rename(entry + '.tmp', entry)
+            stored += 1
+    if args.verbose:
+        print(f'{restored} job outputs restored from, and {stored} stored in, {args.cache}')
+
 # Now reduce each data type, using numpy to do the statistics
 
 import numpy as np
 
-def process(data_file):
-    """process the data in the given file"""
-    with open(data_file) as f:
+# The output of a job for a data type is either a data file, or (if the
+# job was run with --archive) a member <data_type>.dat of the job's
+# compressed archive, given as a tuple (archive, member).
+
+def open_data(data_file):
+    """open a data file or archive member for reading in binary mode"""
+    if isinstance(data_file, tuple):
+        archive, member = data_file
+        return zipfile.ZipFile(archive).open(member)
+    return open(data_file, 'rb')
+
+# By default each file is parsed in bulk into an array of values and
+# an array of tag indices, where the tags are numbered in order of
+# first appearance in the dictionary data.  The statistics for all the
+# tags are then computed at once with grouped sums using np.bincount.
+
+def process(data_file, data):
+    """return arrays of the values and tag indices in the given file, adding new tags to data"""
+    with open_data(data_file) as f:
+        text = f.read().decode()
+    if not text:
+        return np.zeros(0), np.zeros(0, dtype=int)
+    if text.endswith('\n') and text.count('\t') == text.count('\n'): # just value and tag
+        fields = text[:-1].replace('\n', '\t').split('\t')
+    else:
+        fields = [field for line in text.splitlines() for field in line.split('\t')[:2]]
+    tags = fields[1::2]
+    for tag in dict.fromkeys(tags): # the distinct tags, in order
+        data.setdefault(tag, len(data))
+    index = np.fromiter(map(data.__getitem__, tags), dtype=int, count=len(tags))
+    return np.array(fields[0::2], dtype=float), index
+
+def grouped(values, index, ntags):
+    """return the count, mean, and M2 for each tag from lists of value and tag index arrays"""
+    x, i = np.concatenate(values), np.concatenate(index)
+    npt = np.bincount(i, minlength=ntags)
+    mean = np.bincount(i, weights=x, minlength=ntags) / npt
+    m2 = np.bincount(i, weights=(x - mean[i])**2, minlength=ntags)
+    return npt, mean, m2
+
+# In streaming mode only a running count, mean, and sum of squared
+# deviations (M2) are kept for each tag, updated line by line with
+# Welford's algorithm.  The statistics from each file are then merged
+# using the parallel variance formula of Chan, Golub and LeVeque.
+
+def stream(data_file):
+    """return the running statistics for the data in the given file"""
+    stats = {}
+    with io.TextIOWrapper(open_data(data_file)) as f:
         for line in f:
             val, tag = line.rstrip('\n').split('\t')[:2]
-            if tag in data:
-                data[tag].append(val)
+            x = float(val)
+            if tag in stats:
+                s = stats[tag]
+                s[0] += 1
+                delta = x - s[1]
+                s[1] += delta / s[0]
+                s[2] += delta * (x - s[1])
             else:
-                data[tag] = [val]
+                stats[tag] = [1, x, 0.0]
+    return stats
 
-for data_type in data_types:
-    data = {}
+def merge(stats, other):
+    """merge the running statistics in other into stats"""
+    for tag, (nb, mb, m2b) in other.items():
+        if tag in stats:
+            na, ma, m2a = stats[tag]
+            n, delta = na + nb, mb - ma
+            stats[tag] = [n, ma + delta*nb/n, m2a + m2b + delta**2*na*nb/n]
+        else:
+            stats[tag] = [nb, mb, m2b]
+
+# Binary data files (as written with the --binary option in the
+# example drivers) start with the magic string MRMC, then the format
+# version, the number of tags and the tag width as uint32, then the
+# NUL-padded tags, followed by rows of float64 values, one per tag.
+# These are memory-mapped (or read, from an archive) and reduced
+# column-wise, returning the same running statistics as above, with
+# the sums of squared deviations accumulated over blocks of rows.
+
+def is_binary(data_file):
+    """check for the magic string at the start of a binary data file"""
+    with open_data(data_file) as f:
+        return f.read(4) == b'MRMC'
+
+def reduce_binary(data_file):
+    """return the statistics for the data in the given binary file"""
+    with open_data(data_file) as f:
+        version, ntags, width = struct.unpack('<III', f.read(16)[4:])
+        tags = [f.read(width).rstrip(b'\0').decode() for k in range(ntags)]
+        if isinstance(data_file, tuple):
+            values = f.read()
+    offset = 16 + ntags*width
+    if isinstance(data_file, tuple):
+        nrows = len(values) // (8*ntags)
+    else:
+        nrows = (os.path.getsize(data_file) - offset) // (8*ntags)
+    if nrows == 0:
+        return {}
+    if isinstance(data_file, tuple):
+        arr = np.frombuffer(values, dtype='<f8', count=nrows*ntags).reshape(nrows, ntags)
+    else:
+        arr = np.memmap(data_file, dtype='<f8', mode='r', offset=offset, shape=(nrows, ntags))
+    mean = arr.mean(axis=0)
+    m2 = np.zeros(ntags)
+    block = max(1, 2**20 // ntags) # rows at a time, so as not to copy the whole array
+    for i in range(0, nrows, block):
+        m2 += ((arr[i:i+block] - mean)**2).sum(axis=0)
+    return {tag: [nrows, float(mean[k]), float(m2[k])] for k, tag in enumerate(tags)}
+
+# The number of rows (trials) in each file is also counted, as the
+# largest number of values for any tag, for the log file.
+
+def rows(stats):
+    """return the number of rows in the running statistics for a file"""
+    return max((npt for npt, mean, m2 in stats.values()), default=0)
+
+def rows_bulk(index):
+    """return the number of rows in a file from its array of tag indices"""
+    return int(np.bincount(index).max()) if len(index) else 0
+
+def reduce_files(data_files):
+    """return the merged running statistics, and the rows in each file, for a list of data files"""
+    stats, data, values, index, nrows = {}, {}, [], [], []
+    for data_file in data_files:
+        if is_binary(data_file) or args.stream:
+            file_stats = reduce_binary(data_file) if is_binary(data_file) else stream(data_file)
+            nrows.append(rows(file_stats))
+            merge(stats, file_stats)
+        else:
+            x, i = process(data_file, data)
+            nrows.append(rows_bulk(i))
+            values.append(x)
+            index.append(i)
+    if data:
+        npt, mean, m2 = grouped(values, index, len(data))
+        merge(stats, {tag: [int(npt[k]), float(mean[k]), float(m2[k])] for tag, k in data.items()})
+    return stats, nrows
+
+# In incremental mode the running statistics for each data type are
+# kept in a state file <header>_<data_type>.state (as JSON), along with
+# the list of jobs whose outputs have been included.  Only the outputs
+# of jobs not yet included, and which have appeared, are reduced and
+# merged into the state, and the reduced data file is always rewritten.
+
+states = {}
+
+if args.incremental:
+    for data_type in data_types:
+        state_file = f'{args.header}_{data_type}.state'
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                states[data_type] = json.load(f)
+        else:
+            states[data_type] = {'done': [], 'stats': {}}
+        states[data_type].setdefault('trials', {}) # rows reduced from each job
+
+def job_output(k, data_type):
+    """return the data file (or archive member) for the output of job k"""
+    archive = f'{args.header}__{k}.zip'
+    if archive in existing:
+        return (archive, f'{data_type}.dat')
+    return f'{args.header}__{k}_{data_type}.dat'
+
+def jobs_for(data_type):
+    """return the list of jobs whose outputs are to be reduced"""
+    if args.incremental:
+        done = set(states[data_type]['done'])
+        return [k for k in range(args.njobs) if k not in done
+                and (f'{args.header}__{k}.zip' in existing
+                     or f'{args.header}__{k}_{data_type}.dat' in existing)]
+    return range(args.njobs)
+
+def data_files_for(data_type):
+    """return the list of data files to be reduced"""
     if args.njobs:
-        for k in range(args.njobs):
-            process(f'{args.header}__{k}_{data_type}.dat')
+        return [job_output(k, data_type) for k in jobs_for(data_type)]
+    return [f'{args.header}_{data_type}.dat']
+
+# With more than one worker, the data files for all the data types are
+# split into contiguous shards which are reduced to running statistics
+# in a pool of processes (each shard is parsed in bulk, as above, unless
+# --stream is set), and then merged in order so the tags come out
+# in the same order as in a sequential reduction.  The pool is forked
+# so that the workers share the functions defined in this script.
+
+if args.workers > 1:
+    pool = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('fork'))
+    futures = {}
+    for data_type in data_types:
+        data_files = data_files_for(data_type)
+        size = max(1, len(data_files) // (4*args.workers))
+        futures[data_type] = [pool.submit(reduce_files, data_files[i:i+size])
+                              for i in range(0, len(data_files), size)]
+
+trials = {} # by data type, the rows (trials) reduced from each job
+
+for data_type in data_types:
+    data, stats = {}, {}
+    values, index, nrows = [], [], []
+    jobs = list(jobs_for(data_type)) if args.njobs else [None]
+    if args.incremental:
+        stats = states[data_type]['stats']
+    if args.workers > 1:
+        for future in futures[data_type]:
+            shard_stats, shard_rows = future.result()
+            merge(stats, shard_stats)
+            nrows.extend(shard_rows)
     else:
-        process(f'{args.header}_{data_type}.dat')
+        for data_file in data_files_for(data_type):
+            if is_binary(data_file):
+                file_stats = reduce_binary(data_file)
+            elif args.stream or args.incremental:
+                file_stats = stream(data_file)
+            else:
+                x, i = process(data_file, data)
+                nrows.append(rows_bulk(i))
+                values.append(x)
+                index.append(i)
+                continue
+            nrows.append(rows(file_stats))
+            merge(stats, file_stats)
+    trials[data_type] = dict(zip(jobs, nrows))
+    if args.incremental:
+        states[data_type]['trials'].update({str(k): n for k, n in trials[data_type].items()})
+        trials[data_type] = {int(k): n for k, n in states[data_type]['trials'].items()}
+        states[data_type]['done'].extend(jobs)
+        state_file = f'{args.header}_{data_type}.state'
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(states[data_type], f)
+        os.replace(state_file + '.tmp', state_file)
+        if args.verbose:
+            print(f"{data_type}: {len(states[data_type]['done'])} of {args.njobs} jobs reduced")
     data_file = f'{args.header}_{data_type}.dat'
-    if not args.overwrite and os.path.exists(data_file):
+    if not args.overwrite and not args.incremental and os.path.exists(data_file):
         print(f'{data_file} exists, use --overwrite option to overwrite')
     else:
         with open(data_file, 'w') as f:
-            for tag in data:
-                arr = np.array([float(v) for v in data[tag]])
-                mean, var, npt = np.mean(arr), np.var(arr, ddof=1), np.size(arr)
-                sem = np.sqrt(var / npt) # standard error in the mean
+            if data:
+                npt, mean, m2 = grouped(values, index, len(data))
+                with np.errstate(invalid='ignore', divide='ignore'): # nan for a single value
+                    sem = np.sqrt(m2 / (npt - 1) / npt) # standard error in the mean
+                for tag, k in data.items():
+                    f.write('%g\t%g\t%s\t%d\n' % (mean[k], sem[k], tag, npt[k]))
+            for tag, (npt, mean, m2) in stats.items():
+                sem = np.sqrt(m2 / (npt - 1) / npt) if npt > 1 else np.nan
                 f.write('%g\t%g\t%s\t%d\n' % (mean, sem, tag, npt))
         if args.verbose:
             print(f'{data_type} > {data_file}')
 
+if args.workers > 1:
+    pool.shutdown()
+
+# Record the trials reduced from each job in the log file, as with --target-sem
+# the jobs may stop before --ntrial and the .err files may be wiped by --clean.
+
+if trials and os.path.exists(log_file):
+    counts = trials[data_types[0]]
+    line = f'# trials reduced: {sum(counts.values())}'
+    if args.njobs:
+        line += ' (' + ', '.join(f'{k}:{n}' for k, n in sorted(counts.items())) + ')'
+    with open(log_file) as f:
+        contents = [l for l in f if not l.startswith('# trials reduced')] # may be there from an earlier run
+    with open(log_file + '.tmp', 'w') as f:
+        f.writelines(contents + [line + '\n'])
+    os.replace(log_file + '.tmp', log_file)
+
 # Prepend the mapper command line extracted from the first line of condor job description, based on
 # https://stackoverflow.com/questions/4454298/prepend-a-line-to-an-existing-file-in-python
 
@@ -111,24 +482,29 @@ if args.prepend:
         print(f'failed to find {condor_job}, skipping prepend')
         mapper_command = None
     if mapper_command:
-        log_file = args.header + '.log'
         try:
             with open(log_file, 'r+') as f:
                 contents = f.read() # slurp the existing contents
-                f.seek(0) # rewind to the beginning
-                f.write(mapper_command) # write the mapper command
-                f.write(contents) # then the rest of the contents
+                if not contents.startswith(mapper_command): # may be there from an incremental run
+                    f.seek(0) # rewind to the beginning
+                    f.write(mapper_command) # write the mapper command
+                    f.write(contents) # then the rest of the contents
         except IOError:
             print(f'failed to find {log_file}, skipping prepend')
 
-# Clean up output and error files
+# Clean up output and error files, and the data files or archives, but
+# in incremental mode only once the outputs of all the jobs have been
+# reduced.  Only the files found in the directory listing are removed.
 
-if args.clean:
+if args.clean and args.incremental and any(len(states[data_type]['done']) < args.njobs
+                                          for data_type in data_types):
+    print('outputs from some jobs not yet reduced, skipping clean')
+elif args.clean:
+    extensions = (args.wipe.split(',') if args.wipe else []) + ['zip']
     for k in range(args.njobs):
-        if args.wipe:
-            for extension in args.wipe.split(','):
-                os.remove(f'{args.header}__{k}.{extension}')
-        for data_type in data_types:
-            os.remove(f'{args.header}__{k}_{data_type}.dat')
+        for intermediate in [f'{args.header}__{k}.{extension}' for extension in extensions] \
+            + [f'{args.header}__{k}_{data_type}.dat' for data_type in data_types]:
+            if intermediate in existing:
+                os.remove(intermediate)
 
 # End of script
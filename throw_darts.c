@@ -22,33 +22,152 @@ along with this file.  If not, see <http://www.gnu.org/licenses/>.
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#include <time.h>
+#include <pthread.h>
 
 #include "pcg64.h"
 #include "throw_darts.h"
 
 static pcg64_random_t rng;      /* PCG64 random number generator */
 static uint64_t useed, ustream; /* The RNG seed and stream */
+static uint64_t ndraw = 0;      /* number of random numbers drawn */
 
 static int verbose = 0;
 
+/* Cumulative wall-clock times spent throwing and writing, in seconds */
+
+static double throw_time = 0.0, write_time = 0.0;
+
+static double wall_time() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + 1.0e-9*ts.tv_nsec;
+}
+
 /* Stuff to do with radial distribution function */
 /* The final bin records throws outside the target */
 
-static int *gr = NULL; /* Integer array for bin counts */
+static int64_t *gr = NULL; /* Integer array for bin counts */
 static int nbins;      /* number of bins */
 static double delg;    /* bin spacing in r */
 
-/* Initialise with seed and sequence, and number of bins */
+/* To avoid a sqrt per throw, the bins are found from r^2 using the
+   squared bin edges edge2, computed so that the binning is identical
+   to (int)(sqrt(r2)/delg).  A lookup table indexed by (int)(r2 *
+   ncell) gives the lowest bin overlapping each of ncell equal
+   intervals in r^2, which is then corrected using edge2. */
+
+#define MAX_CELLS 65536
+
+static double *edge2 = NULL; /* squared bin edges */
+static int *cell = NULL;     /* lowest bin in each cell */
+static int ncell;            /* number of cells */
+
+/* Sampling strategies.  With uniform sampling (the default) the darts
+   are thrown uniformly over the square.  With stratified sampling the
+   square is divided into an nstrata x nstrata grid of sub-squares, and
+   successive throws in a trial cycle through these, each thrown
+   uniformly within its sub-square, so the number of throws in each
+   sub-square is fixed (exactly if the number of throws is a multiple
+   of nstrata^2).  The position in the cycle is the number of throws
+   so far, found from the bin counts.  With polar sampling, only the
+   target is sampled, drawing r uniformly in [0,1) (the angle is not
+   needed), and each throw is weighted by the ratio of the densities
+   for uniform sampling in the square and for this sampling, which is
+   pi r / 2.  The sums of r in each bin are kept in wgr, alongside the
+   counts in gr, and the final bin is empty. */
+
+#define SAMPLE_UNIFORM 0
+#define SAMPLE_STRATIFIED 1
+#define SAMPLE_POLAR 2
+
+static int sampling = SAMPLE_UNIFORM; /* sampling strategy */
+static int nstrata = 1;               /* number of strata along each side */
+static double *wgr = NULL;            /* sums of r in each bin for polar sampling */
+
+/* Skip-ahead partitioning.  By default each process (and each
+   thread) uses its own RNG stream.  With skip-ahead partitioning, set
+   by set_trial, all processes share one stream, and trial k in the
+   global sequence of trials of trial_throws throws uses the random
+   numbers from k * trial_throws * (draws per throw) onwards.  Each
+   call to throw jumps the RNG (or the RNG for each thread) to the
+   right place, so that the results do not depend on how the trials
+   are split between processes or the throws between threads. */
+
+static int64_t trial = -1;       /* global trial index, or -1 if not used */
+static int64_t trial_throws = 0; /* number of throws per trial */
+
+/* Random numbers are generated in blocks (of throws) before binning */
+
+#define BLOCK 1024
+
+/* Stuff to do with multithreaded throwing, where each thread has its
+   own RNG stream and bin counts, merged into gr after each throw */
+
+typedef struct {
+  pcg64_random_t rng; /* RNG stream for this thread */
+  int64_t *gr;        /* bin counts for this thread */
+  double *wgr;        /* sums of r for this thread (polar sampling) */
+  int64_t first;      /* index in the trial of the first throw */
+  int64_t n;          /* number of throws for this thread */
+  uint64_t ndraw;     /* number of random numbers drawn */
+} worker_t;
+
+static worker_t *workers = NULL; /* Array of workers, one per thread */
+static int nthreads = 1;         /* number of threads */
+
+/* Bin index for r2 = x^2 + y^2, the final bin being outside the target */
+
+static int bin_index(double r2) {
+  return r2 < 1.0 ? (int)(sqrt(r2)/delg) : nbins;
+}
+
+/* Find the squared bin edges and fill the lookup table, searching
+   from an initial guess for the smallest r^2 in each bin or cell */
+
+static void bin_edges() {
+  int i, c;
+  double r2;
+  edge2[0] = 0.0;
+  for (i=1; i<=nbins; i++) {
+    r2 = fmin(1.0, (i*delg)*(i*delg));
+    while (r2 > 0.0 && bin_index(nextafter(r2, 0.0)) >= i) r2 = nextafter(r2, 0.0);
+    while (bin_index(r2) < i) r2 = nextafter(r2, 2.0);
+    edge2[i] = r2;
+  }
+  edge2[nbins+1] = INFINITY;
+  for (c=0; c<ncell; c++) {
+    r2 = (double)c / ncell;
+    while (r2 > 0.0 && (int)(nextafter(r2, 0.0) * ncell) >= c) r2 = nextafter(r2, 0.0);
+    while ((int)(r2 * ncell) < c) r2 = nextafter(r2, 2.0);
+    cell[c] = bin_index(r2);
+  }
+  cell[ncell] = nbins;
+}
+
+/* Initialise with seed and sequence, and number of bins; this can be
+   called again to start afresh, for example for another process */
 
 void initialise_target(int iseed, int istream, int inbins) {
   useed = (uint64_t)iseed;
   ustream = (uint64_t)istream;
   pcg64_srandom_r(&rng, useed, ustream);
+  ndraw = 0;
+  trial = -1;
+  throw_time = write_time = 0.0;
   nbins = inbins; delg = 1.0 / nbins;
-  if ((gr = (int *) malloc((1+nbins)*sizeof(int))) == NULL) {
+  if ((gr = (int64_t *) realloc(gr, (1+nbins)*sizeof(int64_t))) == NULL ||
+      (wgr = (double *) realloc(wgr, (1+nbins)*sizeof(double))) == NULL) {
     fprintf(stderr, "no space for gr at line %i in %s\n", __LINE__, __FILE__);
     exit(1);
   }
+  ncell = nbins <= 256 ? nbins*nbins : MAX_CELLS;
+  if ((edge2 = (double *) realloc(edge2, (2+nbins)*sizeof(double))) == NULL ||
+      (cell = (int *) realloc(cell, (1+ncell)*sizeof(int))) == NULL) {
+    fprintf(stderr, "no space for bin edges at line %i in %s\n", __LINE__, __FILE__);
+    exit(1);
+  }
+  bin_edges();
   reset();
 }
 
@@ -57,39 +176,193 @@ void initialise_target(int iseed, int istream, int inbins) {
 void reset() {
   int i;
   for (i=0; i<(1+nbins); i++) gr[i] = 0;
+  for (i=0; i<(1+nbins); i++) wgr[i] = 0.0;
+}
+
+/* Select the sampling strategy: "uniform", "stratified" (with m x m
+   strata), or "polar".  The counts should be reset afterwards. */
+
+void set_sampling(char *mode, int m) {
+  if (strcmp(mode, "uniform") == 0) sampling = SAMPLE_UNIFORM;
+  else if (strcmp(mode, "stratified") == 0) sampling = SAMPLE_STRATIFIED;
+  else if (strcmp(mode, "polar") == 0) sampling = SAMPLE_POLAR;
+  else fprintf(stderr, "set_sampling: unknown sampling %s, ignored\n", mode);
+  nstrata = m > 1 ? m : 1;
 }
 
 /* Throw n darts at the target of unit radius and bin by distance from
-   centre */
+   centre, using the given RNG and bins, where first is the index in
+   the trial of the first throw (for stratified sampling).  The random
+   numbers for each block of throws are generated first, in the same
+   order as they would be one throw at a time, and then binned in a
+   separate loop. */
+
+static void throw_into(pcg64_random_t *r, int64_t n, int64_t *bins, double *wbins, int64_t first) {
+  int64_t i;
+  int j, m, c, ig, sx, sy;
+  double u[2*BLOCK], x, y, r2, side = 2.0 / nstrata;
+  sx = (int)(first % nstrata); /* the sub-square for stratified sampling */
+  sy = (int)((first / nstrata) % nstrata);
+  for (i=0; i<n; i+=m) {
+    m = n - i < BLOCK ? (int)(n - i) : BLOCK;
+    if (sampling == SAMPLE_POLAR) {
+      pcg64_random_fill_d(r, u, m);
+      for (j=0; j<m; j++) {
+        ig = (int)(u[j] * nbins);
+        if (ig >= nbins) ig = nbins - 1; /* guard against rounding up */
+        bins[ig]++;
+        wbins[ig] += u[j];
+      }
+      continue;
+    }
+    pcg64_random_fill_d(r, u, 2*m);
+    for (j=0; j<m; j++) {
+      if (sampling == SAMPLE_STRATIFIED) {
+        x = side * (sx + u[2*j]) - 1.0;
+        y = side * (sy + u[2*j+1]) - 1.0;
+        if (++sx == nstrata) {
+          sx = 0;
+          if (++sy == nstrata) sy = 0;
+        }
+      } else {
+        x = 2.0 * u[2*j] - 1.0;
+        y = 2.0 * u[2*j+1] - 1.0;
+      }
+      r2 = x*x + y*y;
+      c = (int)(r2 * ncell);
+      ig = cell[c < ncell ? c : ncell];
+      while (r2 >= edge2[ig+1]) ig++;
+      bins[ig]++;
+    }
+  }
+}
+
+/* Number of random numbers drawn per throw */
+
+static int draws_per_throw() {
+  return sampling == SAMPLE_POLAR ? 1 : 2;
+}
+
+/* Use skip-ahead partitioning, with the current trial being trial k of
+   the global sequence of trials of n throws; k = -1 turns this off */
+
+void set_trial(int64_t k, int64_t n) {
+  trial = k;
+  trial_throws = n;
+}
+
+/* Jump the RNG r to the given throw in the current trial, recording
+   the number of random numbers drawn since seeding in nd */
+
+static void skip_to(pcg64_random_t *r, uint64_t *nd, int64_t throws) {
+  pcg128_t n = (pcg128_t)draws_per_throw() * ((pcg128_t)trial * trial_throws + throws);
+  pcg64_srandom_r(r, useed, ustream);
+  pcg64_advance_r(r, n);
+  *nd = (uint64_t)n;
+}
+
+static void *throw_worker(void *arg) {
+  worker_t *w = (worker_t *)arg;
+  memset(w->gr, 0, (1+nbins)*sizeof(int64_t));
+  memset(w->wgr, 0, (1+nbins)*sizeof(double));
+  throw_into(&w->rng, w->n, w->gr, w->wgr, w->first);
+  w->ndraw += draws_per_throw()*w->n;
+  return NULL;
+}
+
+/* Use n threads for throwing.  Thread t uses the stream ustream + t *
+   2^32 with the same seed, so that the threads never share a stream
+   with another process.  With one thread (the default) the single
+   global RNG is used. */
 
-void throw(int n) {
-  int i, ig;
-  double x, y, r2;
-  for (i=0; i<n; i++) {
-    x = 2.0 * pcg64_random_d(&rng) - 1.0;
-    y = 2.0 * pcg64_random_d(&rng) - 1.0;
-    r2 = x*x + y*y;
-    if (r2 < 1.0) ig = (int)(sqrt(r2)/delg);
-    else ig = nbins;
-    gr[ig]++;
+void set_threads(int n) {
+  int t;
+  if (workers != NULL) {
+    for (t=0; t<nthreads; t++) {
+      free(workers[t].gr); free(workers[t].wgr);
+    }
+    free(workers); workers = NULL;
+  }
+  nthreads = n > 1 ? n : 1;
+  if (nthreads == 1) return;
+  if ((workers = (worker_t *) malloc(nthreads*sizeof(worker_t))) == NULL) {
+    fprintf(stderr, "no space for workers at line %i in %s\n", __LINE__, __FILE__);
+    exit(1);
+  }
+  for (t=0; t<nthreads; t++) {
+    pcg64_srandom_r(&workers[t].rng, useed, ustream + ((uint64_t)t << 32));
+    workers[t].ndraw = 0;
+    if ((workers[t].gr = (int64_t *) malloc((1+nbins)*sizeof(int64_t))) == NULL ||
+        (workers[t].wgr = (double *) malloc((1+nbins)*sizeof(double))) == NULL) {
+      fprintf(stderr, "no space for gr at line %i in %s\n", __LINE__, __FILE__);
+      exit(1);
+    }
   }
 }
 
+/* Throw n darts, split between the threads if there are more than one */
+
+void throw(int64_t n) {
+  int t, ig;
+  int64_t first = 0;
+  double start = wall_time();
+  pthread_t *threads;
+  for (ig=0; ig<=nbins; ig++) first += gr[ig]; /* throws so far in this trial */
+  if (nthreads == 1) {
+    if (trial >= 0) skip_to(&rng, &ndraw, first);
+    throw_into(&rng, n, gr, wgr, first);
+    ndraw += draws_per_throw()*n;
+    throw_time += wall_time() - start;
+    return;
+  }
+  if ((threads = (pthread_t *) malloc(nthreads*sizeof(pthread_t))) == NULL) {
+    fprintf(stderr, "no space for threads at line %i in %s\n", __LINE__, __FILE__);
+    exit(1);
+  }
+  for (t=0; t<nthreads; t++) {
+    workers[t].n = n / nthreads + (t < n % nthreads ? 1 : 0);
+    workers[t].first = first;
+    if (trial >= 0) skip_to(&workers[t].rng, &workers[t].ndraw, first);
+    first += workers[t].n;
+    pthread_create(&threads[t], NULL, throw_worker, &workers[t]);
+  }
+  for (t=0; t<nthreads; t++) {
+    pthread_join(threads[t], NULL);
+    for (ig=0; ig<=nbins; ig++) gr[ig] += workers[t].gr[ig];
+    for (ig=0; ig<=nbins; ig++) wgr[ig] += workers[t].wgr[ig]; /* rounding depends on nthreads */
+  }
+  free(threads);
+  throw_time += wall_time() - start;
+}
+
 /* Return the current estimate for pi - the bin count are all inside
-   the target of area pi, and gr[nbins] counts those outside. */
+   the target of area pi, and gr[nbins] counts those outside.  With
+   polar sampling every throw lands inside the target and the weights
+   already contain pi, so there is no estimate and NAN is returned. */
 
 double pi_estimate() {
-  int ig, ncount = 0;
+  int ig;
+  int64_t ncount = 0;
   double area_square = 4.0;
+  if (sampling == SAMPLE_POLAR) return NAN;
   for (ig=0; ig<nbins; ig++) ncount += gr[ig];
   return area_square * (double)(ncount) / (double)(ncount + gr[nbins]);
 }
 
-/* Radial distribution function from centre of target */
+/* Radial distribution function from centre of target, where the
+   weighted count for polar sampling is the sum of the weights pi r / 2 */
+
+static double gr_value(int ig, int64_t norm) {
+  double count, area_annulus, area_square = 4.0;
+  count = sampling == SAMPLE_POLAR ? (M_PI / 2.0) * wgr[ig] : (double)gr[ig];
+  area_annulus = M_PI*((ig+1)*(ig+1) - ig*ig)*delg*delg;
+  return count * area_square / ((double)norm * area_annulus);
+}
 
 void gr_write(char *filename, char *mode) {
-  int ig, norm = 0;
-  double r, g, area_annulus, area_square = 4.0;
+  int ig;
+  int64_t norm = 0;
+  double r, g, start = wall_time();
   FILE *fp;
   if ((fp = fopen(filename, mode)) == NULL) {
     printf("gr_write: %s could not be opened\n", filename); 
@@ -97,26 +370,189 @@ void gr_write(char *filename, char *mode) {
     for (ig=0; ig<=nbins; ig++) norm += gr[ig];
     for (ig=0; ig<nbins; ig++) {
       r = delg * (ig+0.5);
-      area_annulus = M_PI*((ig+1)*(ig+1) - ig*ig)*delg*delg;
-      g = (double)gr[ig] * area_square / ((double)norm * area_annulus);
+      g = gr_value(ig, norm);
       fprintf(fp, "%g\tgr__%g\n", g, r);
     }
     fclose(fp);
   }
+  write_time += wall_time() - start;
   if (verbose > 1) {
     printf("written data to %s, mode %s\n", filename, mode);
   }
 }
 
+/* Binary version of the above.  With mode "w" the file is created
+   with a header containing the magic string MRMC, then the format
+   version, number of tags and width of each tag as uint32, then the
+   NUL-padded tags.  Each call then adds a row of nbins doubles.  The
+   format is little-endian, so the values are written byte by byte
+   whatever the byte order of the host. */
+
+#define TAG_WIDTH 32
+
+static void write_le(FILE *fp, uint64_t v, int nbytes) {
+  int i;
+  unsigned char bytes[8];
+  for (i=0; i<nbytes; i++) bytes[i] = (unsigned char)(v >> (8*i));
+  fwrite(bytes, 1, nbytes, fp);
+}
+
+void gr_write_binary(char *filename, char *mode) {
+  int ig;
+  int64_t norm = 0;
+  uint32_t header[3] = {1, 0, TAG_WIDTH};
+  uint64_t bits;
+  char tag[TAG_WIDTH];
+  double g, start = wall_time();
+  FILE *fp;
+  if ((fp = fopen(filename, strcmp(mode, "w") ? "ab" : "wb")) == NULL) {
+    printf("gr_write_binary: %s could not be opened\n", filename); 
+  } else {
+    if (strcmp(mode, "w") == 0) {
+      header[1] = (uint32_t)nbins;
+      fwrite("MRMC", 1, 4, fp);
+      for (ig=0; ig<3; ig++) write_le(fp, header[ig], 4);
+      for (ig=0; ig<nbins; ig++) {
+        memset(tag, 0, TAG_WIDTH);
+        snprintf(tag, TAG_WIDTH, "gr__%g", delg * (ig+0.5));
+        fwrite(tag, 1, TAG_WIDTH, fp);
+      }
+    }
+    for (ig=0; ig<=nbins; ig++) norm += gr[ig];
+    for (ig=0; ig<nbins; ig++) {
+      g = gr_value(ig, norm);
+      memcpy(&bits, &g, sizeof(double));
+      write_le(fp, bits, 8);
+    }
+    fclose(fp);
+  }
+  write_time += wall_time() - start;
+  if (verbose > 1) {
+    printf("written binary data to %s, mode %s\n", filename, mode);
+  }
+}
+
+/* The functions below which fill or read caller-provided arrays
+   return 0, or -1 if an array is too small, in which case nothing is
+   done and array_error() returns a message (the python wrapper raises
+   a ValueError with this message). */
+
+static char error_message[128];
+
+static int too_small(char *func, int64_t size) {
+  snprintf(error_message, sizeof(error_message),
+           "%s: array too small, need %" PRId64 " values", func, size);
+  return -1;
+}
+
+char *array_error() {
+  return error_message;
+}
+
+/* Save the g(r) values for the current bin counts in the
+   caller-provided array gr_vals (length ngr >= nbins) */
+
+int gr_values(double *gr_vals, int ngr) {
+  int ig;
+  int64_t norm = 0;
+  if (ngr < nbins) return too_small("gr_values", nbins);
+  for (ig=0; ig<=nbins; ig++) norm += gr[ig];
+  for (ig=0; ig<nbins; ig++) gr_vals[ig] = gr_value(ig, norm);
+  return 0;
+}
+
+/* Run ntrial trials of n throws in one go, saving the pi estimates
+   and the g(r) values for each trial in the caller-provided arrays
+   pi_vals (length npi >= ntrial) and gr_vals (length ngr >= ntrial *
+   nbins, one row of nbins values per trial) */
+
+int run_trials(int ntrial, int64_t n, double *pi_vals, int npi, double *gr_vals, int ngr) {
+  int k;
+  int64_t trial0 = trial; /* the first trial, with skip-ahead partitioning */
+  if (npi < ntrial) return too_small("run_trials", ntrial);
+  if (ngr < (int64_t)ntrial * nbins) return too_small("run_trials", (int64_t)ntrial * nbins);
+  for (k=0; k<ntrial; k++) {
+    if (trial0 >= 0) set_trial(trial0 + k, n);
+    reset();
+    throw(n);
+    pi_vals[k] = pi_estimate();
+    gr_values(&gr_vals[(int64_t)k * nbins], nbins);
+    if (verbose > 1) report();
+  }
+  return 0;
+}
+
+/* Functions for checkpointing.  The state of the RNG for thread t (or
+   the single RNG if there is only one thread) is recorded as the
+   number of random numbers drawn since seeding, and restored by
+   re-seeding and advancing.  The bin counts (nbins+1 of them,
+   including the final bin for throws outside the target) can be
+   copied out and back in. */
+
+uint64_t get_draws(int t) {
+  return nthreads == 1 ? ndraw : workers[t].ndraw;
+}
+
+void set_draws(int t, uint64_t n) {
+  if (nthreads == 1) {
+    pcg64_srandom_r(&rng, useed, ustream);
+    pcg64_advance_r(&rng, n);
+    ndraw = n;
+  } else {
+    pcg64_srandom_r(&workers[t].rng, useed, ustream + ((uint64_t)t << 32));
+    pcg64_advance_r(&workers[t].rng, n);
+    workers[t].ndraw = n;
+  }
+}
+
+int get_counts(int64_t *counts, int ncounts) {
+  if (ncounts < 1+nbins) return too_small("get_counts", 1+nbins);
+  memcpy(counts, gr, (1+nbins)*sizeof(int64_t));
+  return 0;
+}
+
+int set_counts(int64_t *counts, int ncounts) {
+  if (ncounts < 1+nbins) return too_small("set_counts", 1+nbins);
+  memcpy(gr, counts, (1+nbins)*sizeof(int64_t));
+  return 0;
+}
+
+/* The sums of r in each bin for polar sampling, copied as above */
+
+int get_weights(double *weights, int nweights) {
+  if (nweights < 1+nbins) return too_small("get_weights", 1+nbins);
+  memcpy(weights, wgr, (1+nbins)*sizeof(double));
+  return 0;
+}
+
+int set_weights(double *weights, int nweights) {
+  if (nweights < 1+nbins) return too_small("set_weights", 1+nbins);
+  memcpy(wgr, weights, (1+nbins)*sizeof(double));
+  return 0;
+}
+
+/* Return the cumulative times spent in throw and in writing g(r) */
+
+double get_throw_time() {
+  return throw_time;
+}
+
+double get_write_time() {
+  return write_time;
+}
+
 void print_uint64(char *s, uint64_t v) {
   printf("uint64 %s = %#018" PRIx64 " = %" PRIu64 "ULL\n", s, v, v);
 }
 void report() {
-  int ig, ncount = 0;
+  int ig;
+  int64_t ncount = 0;
   for (ig=0; ig<nbins; ig++) ncount += gr[ig];
   print_uint64("seed", useed);
   print_uint64("stream", ustream);
-  printf("nsuccess / nthrows = %i / %i\n", ncount, ncount + gr[nbins]);
+  if (nthreads > 1) printf("threads = %i\n", nthreads);
+  if (trial >= 0) printf("trial = %" PRId64 "\n", trial);
+  printf("nsuccess / nthrows = %" PRId64 " / %" PRId64 "\n", ncount, ncount + gr[nbins]);
 }
 
 void set_verbosity(int val) {
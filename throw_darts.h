@@ -21,11 +21,28 @@ along with this file.  If not, see <http://www.gnu.org/licenses/>.
 #ifndef THROW_DARTS_H
 #define THROW_DARTS_H
 
+#include <stdint.h>
+
 void initialise_target(int, int, int);
+void set_threads(int);
 void reset();
-void throw(int);
+void set_sampling(char *, int);
+void set_trial(int64_t, int64_t);
+void throw(int64_t);
 double pi_estimate();
 void gr_write(char *, char *);
+void gr_write_binary(char *, char *);
+char *array_error();
+int gr_values(double *gr_vals, int ngr);
+int run_trials(int ntrial, int64_t n, double *pi_vals, int npi, double *gr_vals, int ngr);
+uint64_t get_draws(int);
+void set_draws(int, uint64_t);
+int get_counts(int64_t *counts, int ncounts);
+int set_counts(int64_t *counts, int ncounts);
+int get_weights(double *weights, int nweights);
+int set_weights(double *weights, int nweights);
+double get_throw_time();
+double get_write_time();
 void report();
 void set_verbosity(int);
 
@@ -23,62 +23,317 @@
 Eg: ./throw_darts.py --header=mytest --seed=12345 --ntrial=100 --nthrow=10^6 -v
 """
 
+import os
+import sys
+import json
+import math
+import time
+import struct
+import zipfile
 import argparse
-import numpy as np
+import resource
+from array import array
+
+# For --metrics, the CPU time used by the interpreter before this
+# point is recorded as the start up CPU time (separately from the wall
+# time, which is measured from here), and the extension import is
+# timed.  NumPy is not needed, so that a job only pays for the python
+# start up and the (small) extension module, which matters when there
+# are many short jobs; the pi and g(r) values are kept in flat
+# array.array buffers which are filled in place by the extension.
+
+startup_time = sum(os.times()[:2])
+start_time = time.perf_counter()
+
 import ThrowDarts as darts
 
+import_time = time.perf_counter() - start_time
+
 # Parse the argument list
 
 parser = argparse.ArgumentParser(description=__doc__)
 parser.add_argument('--header', required=True, help='set the name of the output files')
 parser.add_argument('--seed', default=12345, type=int, help='the RNG seed, default 12345')
 parser.add_argument('--process', default=None, type=int, help='process number, default None')
-parser.add_argument('--njobs', type=int, help='the number of condor jobs (not used here)')
-parser.add_argument('--ntrial', default=10, type=int, help='number of trials, default 10')
+parser.add_argument('--group', default=1, type=int, help='number of processes to run in turn, default 1')
+parser.add_argument('--njobs', type=int, help='the number of condor jobs (only used with --target-sem)')
+parser.add_argument('--ntrial', default=10, type=int, help='number of trials (maximum with --target-sem), default 10')
 parser.add_argument('--nthrow', default='1000', help='number of throws per trial, default 1000')
 parser.add_argument('--nbins', default='20', type=int, help='number of bins in rdf, default 20')
+parser.add_argument('--threads', default=1, type=int, help='number of threads, default 1')
+parser.add_argument('--sampling', default='uniform', choices=['uniform', 'stratified', 'polar'], help='sampling strategy, default uniform')
+parser.add_argument('--strata', default=10, type=int, help='number of strata along each side for stratified sampling, default 10')
+parser.add_argument('--partition', default='stream', choices=['stream', 'skip'], help='RNG partitioning between processes, default stream')
+parser.add_argument('--trial-offset', default=0, type=int, help='index of the first trial with --partition=skip, default 0')
+parser.add_argument('--target-sem', default=None, type=float, help='stop when the overall sem reaches this, default None')
+parser.add_argument('--target', default='pi', choices=['pi', 'gr'], help='use pi or the largest g(r) sem for --target-sem, default pi')
+parser.add_argument('--max-time', default=None, type=float, help='time budget in seconds for --target-sem, default None')
+parser.add_argument('--checkpoint', default=None, type=float, help='checkpoint interval in seconds, default None')
+parser.add_argument('--chunk', default='10^7', help='number of throws between checkpoints, default 10^7')
+parser.add_argument('--resume', action='store_true', help='resume from a checkpoint file if there is one')
+parser.add_argument('--binary', action='store_true', help='write data files in binary format')
+parser.add_argument('--archive', action='store_true', help='write the data files into a single compressed archive')
+parser.add_argument('--metrics', action='store_true', help='write a metrics file with timings for the job')
 parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
 args = parser.parse_args()
 
+if args.target_sem is not None and args.ntrial < 2:
+    parser.error('--target-sem needs --ntrial of at least 2')
+
+if args.sampling == 'polar' and args.target_sem is not None and args.target == 'pi':
+    parser.error('there is no pi estimate with --sampling=polar, use --target=gr')
+
 nthrow = eval(args.nthrow.replace('^', '**')) # catch 10^6 etc
+nbins = args.nbins
 
 darts.set_verbosity(args.verbose)
 
-files = {} # dictionary that will contain file names by data type
+def write_binary(f, tags, values):
+    """write an array of values, row by row, in binary format as in gr_write_binary"""
+    width = 32 # must be big enough for the tags
+    if sys.byteorder == 'big':
+        values = array('d', values)
+        values.byteswap()
+    f.write(b'MRMC' + struct.pack('<III', 1, len(tags), width))
+    f.write(b''.join(tag.encode().ljust(width, b'\0') for tag in tags))
+    f.write(values.tobytes())
+
+def write_data(f, data_type, vals, gr_vals):
+    """write the pi or g(r) values to a file opened in binary mode"""
+    if data_type == 'gr' and args.binary:
+        write_binary(f, ['gr__%g' % x for x in r], gr_vals)
+    elif data_type == 'gr':
+        for k in range(len(vals)):
+            f.write(''.join('%g\tgr__%g\n' % (g, x) for g, x in zip(gr_vals[k*nbins:(k+1)*nbins], r)).encode())
+    elif args.binary:
+        write_binary(f, ['pi'], vals)
+    else:
+        f.write(''.join(str(x) + '\tpi\n' for x in vals).encode())
+
+# With --group, this runs the processes process*group, ..., one after
+# another in the same interpreter, as though each were a separate job
+# with its own RNG stream and output files, so that the start up cost
+# is paid once for the group.  Processes beyond --njobs are skipped.
+
+if args.process is None:
+    processes = [None]
+else:
+    processes = range(args.process*args.group, (args.process+1)*args.group)
+    if args.njobs:
+        processes = [p for p in processes if p < args.njobs]
+
+r = [(1.0 / nbins) * (ig + 0.5) for ig in range(nbins)] # as in gr_write
+
+job_start = start_time
+
+for process in processes:
+
+    files = {} # dictionary that will contain file names by data type
+
+    sub = '' if process is None else '__%d' % process
+
+    for data_type in ['gr'] if args.sampling == 'polar' else ['pi', 'gr']: # no pi estimate for polar
+        files[data_type] = f'{args.header}{sub}_{data_type}.dat'
+
+    # With --partition=skip, all processes share stream 0, and process
+    # p runs trials p*ntrial, ... of the global sequence of trials (from
+    # --trial-offset), jumping ahead in the RNG sequence to each trial,
+    # as in pure_throw_darts.py.  The results for a given trial then do
+    # not depend on the number of jobs (or threads), so a run can be
+    # split differently, or extended with more trials.
+
+    stream = 0 if process is None or args.partition == 'skip' else process
+    first_trial = args.trial_offset + (process or 0) * args.ntrial
+
+    darts.initialise_target(args.seed, stream, args.nbins)
+    darts.set_sampling(args.sampling, args.strata)
+    darts.set_threads(args.threads)
+
+    # Run a number of simulations in one call, collecting the pi
+    # estimates and g(r) values for every trial.
 
-sub = '' if args.process is None else '__%d' % args.process
+    vals = array('d', bytes(8*args.ntrial)) # initialise array to save pi estimates
+    gr_vals = array('d', bytes(8*args.ntrial*nbins)) # and the g(r) values, row by row
 
-for data_type in ['pi', 'gr']:
-    files[data_type] = f'{args.header}{sub}_{data_type}.dat'
+    trial_start = time.perf_counter()
 
-stream = 0 if args.process is None else args.process
+    if args.target_sem is None and args.checkpoint is None:
 
-darts.initialise_target(args.seed, stream, args.nbins)
+        if args.partition == 'skip':
+            darts.set_trial(first_trial, nthrow)
+        darts.run_trials(args.ntrial, nthrow, vals, gr_vals)
 
-# Run a number of simulations.
+    else: # run one trial at a time
 
-vals = np.zeros(args.ntrial) # initialise array to save pi estimates
+        # For checkpointing, each trial is run in chunks of throws, and the
+        # state is saved in a checkpoint file as JSON after a chunk if more
+        # than args.checkpoint seconds have passed since the last save.  The
+        # RNG state is saved as the number of random numbers drawn for each
+        # thread, along with the bin counts (and weights) for the current
+        # trial and the results for the completed trials.  A checkpoint file is written
+        # atomically, and truncated once the run is complete, so that an
+        # empty file means there is nothing to resume from.  With more than
+        # one thread the results depend on the chunk size.
 
-for k in range(0, args.ntrial):
-    darts.reset()
-    darts.throw(nthrow)
-    vals[k] = darts.pi_estimate()
-    darts.gr_write(files['gr'], 'a' if k else 'w') 
-    if args.verbose > 1:
-        darts.report()
+        checkpoint_file = f'{args.header}{sub}.ckpt'
+        chunk = eval(args.chunk.replace('^', '**')) if args.checkpoint is not None else nthrow
+        params = {'seed': args.seed, 'stream': stream, 'nbins': nbins,
+                  'nthrow': nthrow, 'threads': args.threads,
+                  'sampling': args.sampling, 'strata': args.strata,
+                  'partition': args.partition, 'trial_offset': args.trial_offset}
+        counts = array('q', bytes(8*(1+nbins)))
+        weights = array('d', bytes(8*(1+nbins)))
 
-# Save the pi estimate results to the 'pi' file
+        def save_checkpoint(trial, done):
+            """save the state after trial completed trials and done throws of the next"""
+            darts.get_counts(counts)
+            darts.get_weights(weights)
+            ckpt = dict(params, trial=trial, done=done, counts=counts.tolist(),
+                        weights=weights.tolist(),
+                        draws=[darts.get_draws(t) for t in range(args.threads)],
+                        pi=vals[:trial].tolist(),
+                        gr=[gr_vals[k*nbins:(k+1)*nbins].tolist() for k in range(trial)])
+            with open(checkpoint_file + '.tmp', 'w') as f:
+                json.dump(ckpt, f)
+            os.replace(checkpoint_file + '.tmp', checkpoint_file)
 
-with open(files['pi'], 'w') as f:
-    for x in vals:
-        f.write(str(x) + '\tpi\n')
+        first = done = 0 # the first trial to run, and throws already done in it
+
+        if args.resume and os.path.exists(checkpoint_file) and os.path.getsize(checkpoint_file):
+            with open(checkpoint_file) as f:
+                ckpt = json.load(f)
+            if any(ckpt.get(key) != val for key, val in params.items()):
+                sys.exit(f'{checkpoint_file} does not match the run parameters')
+            first, done = ckpt['trial'], ckpt['done']
+            vals[:first] = array('d', ckpt['pi'])
+            gr_vals[:first*nbins] = array('d', [g for row in ckpt['gr'] for g in row])
+            for t, ndraw in enumerate(ckpt['draws']):
+                darts.set_draws(t, ndraw)
+            counts[:] = array('q', ckpt['counts'])
+            darts.set_counts(counts)
+            weights[:] = array('d', ckpt['weights'])
+            darts.set_weights(weights)
+            if args.verbose:
+                print(f'Resuming from {checkpoint_file} at trial {first}, throw {done}')
+
+        # If the njobs jobs each reach a standard error of sem_job, the
+        # standard error of the reduced data is sem_job / sqrt(njobs), so
+        # this sets the target for each job.  Running statistics (count,
+        # mean, M2) are kept for the target quantities with Welford's
+        # algorithm, and at least two trials are always run.
+
+        if args.target_sem is not None:
+            job_target = args.target_sem * math.sqrt(args.njobs or 1)
+            mean = [0.0] * (1 if args.target == 'pi' else nbins)
+            m2 = mean.copy()
+
+        start = last = time.monotonic()
+
+        for k in range(args.ntrial):
+            if k >= first: # otherwise the trial was completed before the checkpoint
+                if k > first or not done:
+                    darts.reset()
+                if args.partition == 'skip':
+                    darts.set_trial(first_trial + k, nthrow)
+                while done < nthrow:
+                    n = min(chunk, nthrow - done)
+                    darts.throw(n)
+                    done += n
+                    if args.checkpoint is not None and time.monotonic() - last > args.checkpoint:
+                        save_checkpoint(k, done)
+                        last = time.monotonic()
+                vals[k] = darts.pi_estimate()
+                darts.gr_values(memoryview(gr_vals)[k*nbins:(k+1)*nbins])
+                done = 0
+                if args.verbose > 1:
+                    darts.report()
+            if args.target_sem is not None:
+                x = [vals[k]] if args.target == 'pi' else gr_vals[k*nbins:(k+1)*nbins]
+                for i, xi in enumerate(x):
+                    delta = xi - mean[i]
+                    mean[i] = mean[i] + delta / (k+1)
+                    m2[i] = m2[i] + delta * (xi - mean[i])
+                sem = max(math.sqrt(v / k / (k+1)) for v in m2) if k else math.inf
+                if sem <= job_target or (args.max_time and time.monotonic() - start > args.max_time):
+                    break
+
+        if os.path.exists(checkpoint_file):
+            open(checkpoint_file, 'w').close()
+
+        if args.target_sem is not None:
+            ntrial = k + 1
+            vals, gr_vals = vals[:ntrial], gr_vals[:ntrial*nbins]
+            print(f'{args.target} sem = {sem:g} (target {job_target:g}) after {ntrial} trials', file=sys.stderr)
+
+    trial_time = time.perf_counter() - trial_start
+
+    # Save the g(r) and pi estimate results to the 'gr' and 'pi' files,
+    # or with --archive to the members gr.dat and pi.dat of a single
+    # compressed archive <header>__<proc_id>.zip, which reduces the
+    # number of files to transfer and clean up.  The data files and the
+    # archive are written atomically (via a temporary file) so that an
+    # incremental reducer never sees part of one.
+
+    write_start = time.perf_counter()
+
+    if args.archive:
+        archive = f'{args.header}{sub}.zip'
+        with zipfile.ZipFile(archive + '.tmp', 'w', zipfile.ZIP_DEFLATED) as z:
+            for data_type in files:
+                with z.open(f'{data_type}.dat', 'w') as f:
+                    write_data(f, data_type, vals, gr_vals)
+        os.replace(archive + '.tmp', archive)
+        files = {data_type: f'{archive}:{data_type}.dat' for data_type in files}
+    else:
+        for data_type, data_file in files.items():
+            with open(data_file + '.tmp', 'wb') as f:
+                write_data(f, data_type, vals, gr_vals)
+            os.replace(data_file + '.tmp', data_file)
+
+    write_time = time.perf_counter() - write_start
+
+    # Write the metrics for the job as a JSON record, with the times
+    # in seconds.  The time spent in throw is measured in the C code,
+    # and the rest of the time running the trials is overhead in
+    # python.  In a group the start up and import are charged to the
+    # first process.  The start up is CPU time (with the resolution of
+    # os.times), so it is reported separately and is not part of the wall
+    # time.  The metrics files are aggregated by timing.py
+    # --metrics.
+
+    if args.metrics:
+        wall = time.perf_counter() - job_start
+        throws = len(vals) * nthrow
+        metrics = {'script': os.path.basename(__file__), 'process': process,
+                   'threads': args.threads, 'ntrial': len(vals), 'nthrow': nthrow,
+                   'sem': sem if args.target_sem is not None else None,
+                   'startup_cpu': startup_time, 'import': import_time,
+                   'throw': darts.get_throw_time(), 'trials': trial_time,
+                   'write': write_time, 'wall': wall,
+                   'throws_per_sec': throws / wall,
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+        with open(f'{args.header}{sub}.metrics', 'w') as f:
+            json.dump(metrics, f)
+            f.write('\n')
+
+    startup_time = import_time = 0.0
+    job_start = time.perf_counter()
 
 # Summarise the run to a log file using f-strings and a line 'data collected'
 
 run_time = f'./{__file__} --header={args.header} --seed={args.seed}' \
            f' --ntrial={args.ntrial} --nthrow={args.nthrow} --nbins={args.nbins}'
 
-if not args.process: # true if args.process is None or 0
+if args.partition != 'stream':
+    run_time += f' --partition={args.partition} --trial-offset={args.trial_offset}'
+
+if args.sampling != 'uniform':
+    run_time += f' --sampling={args.sampling}' + (f' --strata={args.strata}' if args.sampling == 'stratified' else '')
+
+if args.target_sem is not None:
+    run_time += f' --target-sem={args.target_sem} --target={args.target}'
+
+if args.process is None or 0 in processes:
     with open(args.header + '.log', 'w') as f:
         f.write('# ' + run_time + '\n')
         f.write('# data collected for: ' + ','.join(files.keys()) + '\n')
@@ -21,34 +21,107 @@
 """Report timing data from a DAGMan run
 
 Eg: ./timing.py header, or headre__dag.job.nodes.log (the tail gets cut off after the '__')
+    ./timing.py header --metrics (for jobs run with --metrics)
 """
 
+import os
+import glob
+import json
 import argparse
 from datetime import timedelta
 
 parser = argparse.ArgumentParser(__doc__)
 parser.add_argument('header', help='the name of the output and job files')
+parser.add_argument('--metrics', action='store_true', help='aggregate the job metrics files')
 parser.add_argument('-v', '--verbose', action='count', default=0, help='increasing verbosity')
 args = parser.parse_args()
 
 header = args.header.split('__')[0]
 
+def percentile(values, p):
+    """the p-th percentile of a list of values, by the nearest rank"""
+    values = sorted(values)
+    return values[max(0, -(-len(values)*p//100) - 1)]
+
+def percentiles(values):
+    """summarise a list of job durations in seconds"""
+    return ', '.join(f'p{p} = {percentile(values, p):.3f}s' for p in [50, 90, 99]) \
+        + f', max = {max(values):.3f}s'
+
 dag_log = f'{header}__dag.job.nodes.log'
 
-total = count = 0
+# The DAGMan log is optional with --metrics, as local jobs do not have one
+
+if not args.metrics or os.path.exists(dag_log):
+
+    durations = []
+
+    with open(dag_log) as f:
+        for line in f:
+            if 'Total Remote' in line:
+                h, m, s = [int(s) for s in line.split(',')[0].split()[2].split(':')]
+                durations.append(3600*h + 60*m + s)
+                if args.verbose:
+                    print(line)
+
+    total, count = sum(durations), len(durations)
+
+    result = f'{dag_log}: total run time = {timedelta(seconds=total)}, ' \
+             f'mean run time ({count} jobs) = {timedelta(seconds=int(total/count))}'
+
+    print(result)
+    print(f'{dag_log}: run time percentiles:', percentiles(durations))
+
+# Aggregate the metrics files written by the workers with --metrics.
+# The wall time of each job (from the end of the python start up) is
+# split into phases: import (numpy and extension modules), throw (in
+# the dart throwing kernel), the overhead in the trial loop, writing
+# the data files, and anything else (argument parsing, setting up).
+# The start up of the python interpreter is CPU time, so it is
+# reported separately rather than as a fraction of the wall time.
+
+if args.metrics:
+
+    metrics_files = sorted(glob.glob(f'{header}__*.metrics'))
+
+    if not metrics_files:
+        raise FileNotFoundError(f'no metrics files for {header}')
+
+    records = []
+
+    for metrics_file in metrics_files:
+        with open(metrics_file) as f:
+            records.append(json.load(f))
+        if args.verbose:
+            print(metrics_file, records[-1])
+
+    phases = {'import': [m['import'] for m in records],
+              'throw': [m['throw'] for m in records],
+              'overhead': [m['trials'] - m['throw'] for m in records],
+              'write': [m['write'] for m in records]}
+
+    phases['other'] = [m['wall'] - sum(phase[k] for phase in phases.values())
+                       for k, m in enumerate(records)]
+
+    walls = [m['wall'] for m in records]
+    total = sum(walls)
+
+    print(f'{header}: {len(records)} jobs, total wall time = {total:.3f}s')
+
+    for name, times in phases.items():
+        print('%-10s total = %10.3fs  mean = %9.4fs  fraction = %6.2f%%' %
+              (name, sum(times), sum(times)/len(times), 100*sum(times)/total))
+
+    startup = [m['startup_cpu'] for m in records]
+
+    print('%-10s total = %10.3fs  mean = %9.4fs  (CPU time, not in the wall time)' %
+          ('startup', sum(startup), sum(startup)/len(startup)))
 
-with open(dag_log) as f:
-    for line in f:
-        if 'Total Remote' in line:
-            h, m, s = [int(s) for s in line.split(',')[0].split()[2].split(':')]
-            total += 3600*h + 60*m + s
-            count += 1
-            if args.verbose:
-                print(line)
+    print(f'{header}: wall time percentiles:', percentiles(walls))
 
-result = f'{dag_log}: total run time = {timedelta(seconds=total)}, ' \
-         f'mean run time ({count} jobs) = {timedelta(seconds=int(total/count))}'
+    throws = sum(m['ntrial'] * m['nthrow'] for m in records)
 
-print(result)
+    print(f'{header}: {throws} throws, {throws/total:.4g} throws/s per job, '
+          f'peak RSS = {max(m["peak_rss_kb"] for m in records)} kB')
 
 # End of script